@@ -0,0 +1,105 @@
+"""admission.py - Cheap admission checks for the Battleship endpoints, run
+before a request does any datastore I/O. Requests are limited per User and
+per Game key with token buckets kept in instance memory. Requests a bucket
+admits are also counted in memcache, so a client spreading its requests
+over many instances is still limited. A request refused by its instance's
+bucket costs no RPC at all."""
+
+import threading
+import time
+from google.appengine.api import memcache
+import endpoints
+
+import settings
+import utils
+
+NAMESPACE = 'admission'
+
+_lock = threading.Lock()
+_buckets = {}
+
+
+class TokenBucket(object):
+    """Holds up to burst tokens, refilled at rate tokens per second"""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now, cost=1):
+        """Takes cost tokens. Returns False when the bucket is empty. A
+        cost above the tokens left is admitted and runs the bucket into
+        debt, so batches larger than burst aren't refused forever"""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= cost
+        return True
+
+
+def _take_local(name, rate, burst, now, cost):
+    with _lock:
+        bucket = _buckets.get(name)
+        if bucket is None:
+            # Forgetting every bucket at once only lets a burst through
+            if len(_buckets) >= settings.ADMISSION_MAX_BUCKETS:
+                _buckets.clear()
+            bucket = _buckets[name] = TokenBucket(burst, now)
+        return bucket.take(rate, burst, now, cost)
+
+
+def _take_shared(costs, rate, burst, now):
+    """Adds the cost of each name to the memcache counter every instance
+    shares for the current window of burst / rate seconds, with one RPC.
+    Returns the names refused, those whose counter was already at burst.
+    Admits everything when memcache is unavailable"""
+    window = max(1, int(burst / rate))
+    suffix = ':{}'.format(int(now) // window)
+    counters = dict((name + suffix, cost) for name, cost in costs.items())
+    # Counters of past windows are never read again and age out of memcache
+    if len(counters) == 1:
+        counter, cost = counters.items()[0]
+        counts = {counter: memcache.incr(counter, cost, namespace=NAMESPACE,
+                                         initial_value=0)}
+    else:
+        counts = memcache.offset_multi(counters, namespace=NAMESPACE,
+                                       initial_value=0) or {}
+    return set(name for name, cost in costs.items()
+               if counts.get(name + suffix) is not None and
+               counts[name + suffix] - cost >= burst)
+
+
+def admit_multi(scope, costs):
+    """Takes costs[key] tokens for each key from the buckets of scope,
+    'user' or 'game', see RATE_LIMITS in settings.py. The shared counters
+    of all the keys cost one memcache call. Returns the keys refused"""
+    if not settings.ADMISSION_ENABLED:
+        return set()
+    rate, burst = settings.RATE_LIMITS[scope]
+    names = dict(('{}:{}'.format(scope, key), key) for key in costs)
+    now = time.time()
+    refused = set(name for name, key in names.items()
+                  if not _take_local(name, rate, burst, now, costs[key]))
+    admitted = dict((name, costs[key]) for name, key in names.items()
+                    if name not in refused)
+    if settings.ADMISSION_SHARED and admitted:
+        refused.update(_take_shared(admitted, rate, burst, now))
+    return set(names[name] for name in refused)
+
+
+def admit(scope, key):
+    """Takes a token for key from the buckets of scope, see admit_multi.
+    Raises ForbiddenException when the key has used up its requests"""
+    if admit_multi(scope, {key: 1}):
+        raise endpoints.ForbiddenException('Rate limit exceeded')
+
+
+def decode_key(urlsafe, model):
+    """Decodes a urlsafe key of the model's kind without any RPC. Raises
+    NotFoundException when it isn't one"""
+    try:
+        return utils.decode_key(urlsafe, model)
+    except (endpoints.BadRequestException, ValueError):
+        raise endpoints.NotFoundException('Invalid Game Key!!!!!')
@@ -6,22 +6,40 @@ primarily with communication to/from the API's users."""
 
 
 import logging
+from bisect import bisect_right
 import endpoints
 from protorpc import remote, messages
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
-from models import User, Game, Score
+from models import (User, Game, Score, Leaderboard, GlobalStats, StatShard,
+                    ActiveGames, GameSnapshot)
 from forms import (
   StringMessage,
   NewGameForm,
+  NewGamesForm,
   GameForm,
+  GameResultForm,
+  GameResultForms,
   MakeMoveForm,
+  MakeMovesForm,
+  MoveResultForm,
+  MoveResultForms,
   UserGameForm,
   UserActiveGamesForms,
   HighScoreForms,
   UserRankingForms,
-  HistoryGameForms)
+  HistoryGameForms,
+  StatsForm)
 
-from utils import get_by_urlsafe
+from board import MAX_CELLS
+from utils import decode_key, get_user_name_async
+import admission
+import cache
+import engine
+import settings
+from instrumentation import instrumented, lap
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -31,6 +49,238 @@ MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+USER_STATS_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1, required=True),)
+
+# Error of the items of new_games and make_moves whose batch didn't commit
+SAVE_FAILED = 'Could not save, please retry'
+
+
+def _page_size(request):
+    page_size = min(request.page_size or settings.DEFAULT_PAGE_SIZE,
+                    settings.MAX_PAGE_SIZE)
+    if page_size < 1:
+        raise endpoints.BadRequestException('Page size must be at least 1')
+    return page_size
+
+
+@ndb.tasklet
+def _fetch_page_async(query, request):
+    """Runs a keys-only query for the page described by the request's
+    page_size and cursor. Returns the keys, the urlsafe cursor of the next
+    page and whether more results follow"""
+    page_size = _page_size(request)
+    try:
+        cursor = Cursor(urlsafe=request.cursor)
+    except (datastore_errors.BadValueError, TypeError):
+        raise endpoints.BadRequestException('Invalid Cursor')
+
+    keys, next_cursor, more = yield query.fetch_page_async(
+        page_size, start_cursor=cursor, keys_only=True)
+    raise ndb.Return(keys, next_cursor.urlsafe() if next_cursor else None,
+                     more)
+
+
+@ndb.tasklet
+def _user_page_async(request, make_query):
+    """Looks up the request's User and fetches the requested page of
+    make_query(user key) at the same time. Users are keyed by name, so the
+    page doesn't have to wait for the lookup. Returns the User, or None if
+    there is none, and the page"""
+    if not User.valid_name(request.user_name):
+        raise ndb.Return(None, None)
+    user_key = User.key_for_name(request.user_name)
+    user, page = yield (User.get_by_name_async(request.user_name),
+                        _fetch_page_async(make_query(user_key), request))
+    if user and user.key != user_key:
+        # Users on automatic ids are only found once the lookup is done
+        page = yield _fetch_page_async(make_query(user.key), request)
+    raise ndb.Return(user, page)
+
+
+def _apply_guess(game, guess):
+    """Applies a guess to a loaded Game that isn't over yet, see
+    engine.play. Returns the message for the player"""
+    try:
+        return engine.play(game, guess)
+    except engine.InvalidMove, e:
+        raise endpoints.NotFoundException(str(e))
+
+
+@ndb.tasklet
+def _make_move_async(game_key, guess):
+    """Applies a guess to a Game, see _commit_move_async. A game that ends
+    is dropped from the owner's ActiveGames once the move has committed.
+    Returns the Game and the message for the player"""
+    game, message, ended = yield _commit_move_async(game_key, guess)
+    if ended:
+        yield ActiveGames.update_async(game.user, removed=[game_key])
+    raise ndb.Return(game, message)
+
+
+@ndb.transactional_tasklet(xg=True)
+def _commit_move_async(game_key, guess):
+    """Applies a guess to a Game. When that ends the game it is counted in
+    the owner's StatShards and snapshotted for the history, written with
+    the Game in one put_multi inside the transaction. Returns the Game,
+    the message for the player and whether the move ended the game"""
+    game = yield game_key.get_async()
+    if not game:
+        raise endpoints.NotFoundException('Game Does Not Exist')
+
+    # Checks if game is already over
+    if game.game_over:
+        raise ndb.Return(game, 'Game already over!', False)
+
+    message = _apply_guess(game, guess)
+    if not game.game_over:
+        yield game.put_async()
+        raise ndb.Return(game, message, False)
+
+    shards = yield StatShard.tally_async(
+        {game.user: StatShard.game_ended(game)})
+    yield ndb.put_multi_async([game, GameSnapshot.for_game(game)] + shards)
+    raise ndb.Return(game, message, True)
+
+
+@ndb.transactional_tasklet(xg=True)
+def _make_moves_async(moves):
+    """Applies a batch of (index, game key, user key, guess) moves, in
+    order, with one get_multi of the games and one put_multi. Games that
+    end are counted in their owners' StatShards and snapshotted for the
+    history. The games and those must span at most 25 entity groups.
+    Returns a MoveResultForm per move and the keys of the games that
+    ended, by owner"""
+    game_keys = list(set(move[1] for move in moves))
+    loaded = yield ndb.get_multi_async(game_keys)
+    games = dict(zip(game_keys, loaded))
+
+    results = []
+    changed = set()
+    ended = {}
+    finished = {}
+    for index, game_key, user_key, guess in moves:
+        result = MoveResultForm(index=index,
+                                urlsafe_game_key=game_key.urlsafe(),
+                                guess=guess)
+        results.append(result)
+        game = games[game_key]
+        if not game:
+            result.error = 'Game Does Not Exist'
+            continue
+        if game.game_over:
+            result.message = 'Game already over!'
+        else:
+            try:
+                result.message = _apply_guess(game, guess)
+            except endpoints.ServiceException, e:
+                result.error = str(e)
+                continue
+            changed.add(game_key)
+            if game.game_over:
+                finished.setdefault(game.user, []).append(game_key)
+                counts = ended.setdefault(game.user, {})
+                for name, amount in StatShard.game_ended(game).items():
+                    counts[name] = counts.get(name, 0) + amount
+        result.attempts_remaining = game.attempts_remaining
+        result.game_over = game.game_over
+
+    shards, snapshots = [], []
+    if ended:
+        shards = yield StatShard.tally_async(ended)
+        snapshots = [GameSnapshot.for_game(games[key])
+                     for keys in finished.values() for key in keys]
+    yield ndb.put_multi_async([games[key] for key in changed] + shards +
+                              snapshots)
+    raise ndb.Return(results, finished)
+
+
+def _move_batches(moves):
+    """Splits (index, game key, user key, guess) moves into batches
+    that each fit one cross-group transaction. Moves on the same game stay
+    in one batch, in their original order. Each owner costs one more
+    group, the StatShard their games are counted in. Games are taken owner
+    by owner, so an owner's games share as few batches as possible. Returns
+    the batches"""
+    batches, batch, groups = [], [], set()
+    by_game = {}
+    for move in moves:
+        by_game.setdefault(move[1], []).append(move)
+    for game_moves in sorted(by_game.values(), key=lambda m: m[0][2]):
+        game_key, user_key = game_moves[0][1], game_moves[0][2]
+        needed = set([game_key, user_key]) - groups
+        if len(groups) + len(needed) > settings.MAX_TRANSACTION_GROUPS:
+            batches.append(batch)
+            batch, groups = [], set()
+            needed = set([game_key, user_key])
+        batch.extend(game_moves)
+        groups.update(needed)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@ndb.tasklet
+def _make_move_batch_async(batch):
+    """Commits a batch of moves. A batch that fails to commit gets an
+    error result for each of its moves. Returns the results and the keys of
+    the games that ended, by owner"""
+    try:
+        results, finished = yield _make_moves_async(batch)
+    except datastore_errors.Error, e:
+        logging.warning('Could not save %d moves: %s', len(batch), e)
+        results = [MoveResultForm(index=index,
+                                  urlsafe_game_key=key.urlsafe(),
+                                  guess=guess, error=SAVE_FAILED)
+                   for index, key, _, guess in batch]
+        finished = {}
+    raise ndb.Return(results, finished)
+
+
+@ndb.tasklet
+def _cancel_game_async(game_key):
+    """Deletes a game in progress and counts it as cancelled, then drops it
+    from the owner's ActiveGames"""
+    user_key = yield _delete_game_async(game_key)
+    yield ActiveGames.update_async(user_key, removed=[game_key])
+
+
+@ndb.transactional_tasklet(xg=True)
+def _delete_game_async(game_key):
+    """Deletes a game in progress and counts it as cancelled in the same
+    transaction. Returns the owner's key"""
+    game = yield game_key.get_async()
+    if not game:
+        raise endpoints.NotFoundException('Game Does Not Exist')
+    # Checks if game is already finished
+    if game.game_over is True:
+        raise endpoints.NotFoundException('Game Is Already Over')
+    shards = yield StatShard.tally_async(
+        {game.user: {'games_cancelled': 1}})
+    yield ndb.put_multi_async(shards), game_key.delete_async()
+    raise ndb.Return(game.user)
+
+
+def _form_fields(request):
+    """Returns the optional Game form fields a request asked for"""
+    try:
+        return Game.form_fields(request.compact, request.fields)
+    except ValueError, e:
+        raise endpoints.BadRequestException(str(e))
+
+
+def _check_new_game(request):
+    """Validates the board, ships and attempts of a new game request, see
+    engine.check_setup. Returns the ship lengths"""
+    ship_lengths = request.ships or [1]
+    try:
+        engine.check_setup(request.width, request.height, request.attempts,
+                           ship_lengths)
+    except engine.InvalidAttempts, e:
+        raise endpoints.NotFoundException(str(e))
+    except engine.RuleError, e:
+        raise endpoints.BadRequestException(str(e))
+    return ship_lengths
 
 
 @endpoints.api(name='battleship', version='v1')
@@ -42,199 +292,411 @@ class Battleship(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
+    @ndb.synctasklet
     def create_user(self, request):
         """Create a User. Requires a unique username"""
         if not request.user_name:
-            return StringMessage(message='Enter a Username')
+            raise ndb.Return(StringMessage(message='Enter a Username'))
 
-        if User.query(User.name == request.user_name).get():
+        try:
+            user = yield User.create_async(request.user_name, request.email)
+        except ValueError, e:
+            raise endpoints.BadRequestException(str(e))
+        if not user:
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
-        return StringMessage(message='User {} created!'.format(
-                request.user_name))
+        lap('logic')
+        raise ndb.Return(StringMessage(message='User {} created!'.format(
+                request.user_name)))
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
+    @ndb.synctasklet
     def new_game(self, request):
-        """Creates new game. Choose attempts between 1-25, default is 5"""
-        user = User.query(User.name == request.user_name).get()
+        """Creates new game. Choose the board size (default 5x5), the
+        lengths of the ships (default one ship of length 1) and attempts
+        between 1 and the number of cells, default is 5"""
+        ship_lengths = _check_new_game(request)
+        admission.admit('user', request.user_name)
+        user = yield User.get_by_name_async(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        if request.attempts < 1:
-            raise endpoints.NotFoundException(
-                    'Attempts Remaining needs to be more than 0')
-        if request.attempts > 26:
+        lap('lookup')
+        try:
+            game = Game.build(user.key, request.attempts, request.width,
+                              request.height, ship_lengths)
+        except ValueError, e:
+            raise endpoints.BadRequestException(str(e))
+        errors = yield Game.save_new_async(user.key, [game])
+        if errors[0]:
+            raise errors[0]
+        lap('logic')
+
+        raise ndb.Return(game.to_form('Good luck playing Battleship!',
+                                      user.name))
+
+    @endpoints.method(request_message=NewGamesForm,
+                      response_message=GameResultForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented
+    @ndb.synctasklet
+    def new_games(self, request):
+        """Creates count new games for a User in one call. Takes the same
+        options as new_game. Returns a result per game"""
+        if not 1 <= request.count <= settings.MAX_BULK_GAMES:
+            raise endpoints.BadRequestException(
+                    'Count needs to be between 1 and {}'.format(
+                        settings.MAX_BULK_GAMES))
+        ship_lengths = _check_new_game(request)
+        admission.admit('user', request.user_name)
+        user = yield User.get_by_name_async(request.user_name)
+        if not user:
             raise endpoints.NotFoundException(
-                    'Attempts Remaining needs to be less than 26')
-        game = Game.new_game(user.key, request.attempts)
-
-        return game.to_form('Good luck playing Battleship!')
+                    'A User with that name does not exist!')
+        lap('lookup')
+
+        results = []
+        games = []
+        for _ in range(request.count):
+            try:
+                games.append(Game.build(user.key, request.attempts,
+                                        request.width, request.height,
+                                        ship_lengths))
+                results.append(GameResultForm())
+            except ValueError, e:
+                results.append(GameResultForm(error=str(e)))
+        errors = yield Game.save_new_async(user.key, games)
+        lap('logic')
+
+        saved = iter(zip(games, errors))
+        for result in results:
+            if not result.error:
+                game, error = next(saved)
+                if error:
+                    result.error = SAVE_FAILED
+                else:
+                    result.game = game.to_form(
+                        'Good luck playing Battleship!', user.name)
+        raise ndb.Return(GameResultForms(items=results))
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
+    @ndb.synctasklet
     def make_move(self, request):
-        """Makes a move between 1-25. Returns
-        a game form with game information"""
+        """Makes a move on a cell between 1 and the number of cells
+        on the board. Returns a game form with game information"""
         if len(request.urlsafe_game_key) != 51:
             raise endpoints.NotFoundException('Invalid Game Key!!!!!')
 
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-
-        # Check if game exists
-        if not game:
-            raise endpoints.NotFoundException('Game Does Not Exist')
-
-        user_key = Game.query(Game.user == game.user).get()
-        score = Score.query(Score.user == user_key.user).get()
-        # Creates a Score Model for the user if one does not exist
-        if not score:
-            game.user_score()
-            game.put()
-
-        score = Score.query(Score.user == user_key.user).get()
-
-        # Checks if game is already over
-        if game.game_over:
-            return game.to_form('Game already over!')
-
-        # Checks if game is within limits of the board
-        if request.guess < 1 or request.guess > 25:
+        # Checks if the guess can be on any board, before any datastore read
+        if request.guess < 1 or request.guess > MAX_CELLS:
             raise endpoints.NotFoundException(
                 'Invalid Move, Outside Grid Boundaries'
             )
+        fields = _form_fields(request)
+        key = admission.decode_key(request.urlsafe_game_key, Game)
+        admission.admit('game', key.urlsafe())
 
-        # Checks for duplicate guesses
-        for guesses in game.guesses:
-            if guesses == request.guess:
-                raise endpoints.NotFoundException(
-                    'Already Guessed This Number'
-                )
-
-        # Last turn, Game Over
-        if game.attempts_remaining == 1:
-            game.attempts_remaining -= 1
-            game.guesses.append(request.guess)
-            game.game_over = True
-            game.put()
-            score.losses += 1
-            score.percentage = score.victories/(score.victories + score.losses)
-            score.put()
-            return game.to_form('Game over!')
-
-        game.attempts_remaining -= 1
-        game.guesses.append(request.guess)
-
-        # Guess the correct location of the ship
-        if request.guess == game.ship_location:
-            game.game_over = True
-            game.put()
-            score.victories += 1
-            score.percentage = score.victories/(score.victories + score.losses)
-            score.put()
-            return game.to_form('You win!')
-
-        if request.guess != game.ship_location:
-            game.put()
-            return game.to_form('You Missed!')
+        game = cache.get_by_urlsafe_cached(request.urlsafe_game_key, Game)
+
+        # Check if game exists
+        if not game:
+            raise endpoints.NotFoundException('Game Does Not Exist')
+        admission.admit('user', game.user.id())
+        lap('lookup')
+
+        # Users on automatic ids are fetched while the move commits
+        user_name = get_user_name_async(game.user)
+        game, message = yield _make_move_async(game.key, request.guess)
+        user_name = yield user_name
+        lap('logic')
+        raise ndb.Return(game.to_form(message, user_name, fields))
+
+    @endpoints.method(request_message=MakeMovesForm,
+                      response_message=MoveResultForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    @ndb.synctasklet
+    def make_moves(self, request):
+        """Makes moves across many games in one call. Moves on the same
+        game are applied in request order. Returns a result per move"""
+        if len(request.moves) > settings.MAX_BULK_MOVES:
+            raise endpoints.BadRequestException(
+                    'At most {} moves per request'.format(
+                        settings.MAX_BULK_MOVES))
+
+        results = {}
+        decoded = []
+        for index, move in enumerate(request.moves):
+            result = MoveResultForm(index=index,
+                                    urlsafe_game_key=move.urlsafe_game_key,
+                                    guess=move.guess)
+            try:
+                key = decode_key(move.urlsafe_game_key, Game)
+            except (endpoints.BadRequestException, ValueError):
+                key = None
+            if not key:
+                result.error = 'Invalid Key'
+            elif move.guess < 1 or move.guess > MAX_CELLS:
+                result.error = 'Invalid Move, Outside Grid Boundaries'
+            else:
+                decoded.append((index, key, move.guess))
+                continue
+            results[index] = result
+
+        # Each game pays for all of its moves in one admission check
+        costs = {}
+        for _, key, _ in decoded:
+            costs[key.urlsafe()] = costs.get(key.urlsafe(), 0) + 1
+        refused = admission.admit_multi('game', costs)
+        if refused:
+            for index, key, guess in decoded:
+                if key.urlsafe() in refused:
+                    results[index] = MoveResultForm(
+                        index=index, urlsafe_game_key=key.urlsafe(),
+                        guess=guess, error='Rate limit exceeded')
+            decoded = [move for move in decoded
+                       if move[1].urlsafe() not in refused]
+
+        # The owners of the games are needed to batch their StatShards
+        game_keys = list(set(move[1] for move in decoded))
+        games = yield cache.get_multi_async(game_keys)
+        owners = dict((key, game.user) for key, game in
+                      zip(game_keys, games) if game)
+        moves = []
+        for index, key, guess in decoded:
+            if key in owners:
+                moves.append((index, key, owners[key], guess))
+            else:
+                results[index] = MoveResultForm(
+                    index=index, urlsafe_game_key=key.urlsafe(),
+                    guess=guess, error='Game Does Not Exist')
+        lap('lookup')
+
+        committed = yield [_make_move_batch_async(batch)
+                           for batch in _move_batches(moves)]
+        finished = {}
+        for batch_results, batch_finished in committed:
+            results.update((result.index, result)
+                           for result in batch_results)
+            for user_key, keys in batch_finished.items():
+                finished.setdefault(user_key, []).extend(keys)
+        # Once per owner, after every batch has committed
+        yield [ActiveGames.update_async(user_key, removed=keys)
+               for user_key, keys in finished.items()]
+        lap('logic')
+
+        raise ndb.Return(MoveResultForms(items=[results[index]
+                                                for index in sorted(results)]))
 
     @endpoints.method(request_message=UserGameForm,
                       response_message=UserActiveGamesForms,
                       path='user/games',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_user_games(self, request):
-        """Returns all of a User's active games."""
-        user = User.query(User.name == request.user_name).get()
+        """Returns all of a User's active games, read from their
+        ActiveGames index in key order. The cursor is the key of the last
+        game of the previous page, so games added or finished in between
+        don't shift the pages. Set compact or list the wanted board fields
+        to shrink the response"""
+        fields = _form_fields(request)
+        page_size = _page_size(request)
+        after = None
+        if request.cursor:
+            try:
+                after = decode_key(request.cursor, Game)
+            except (endpoints.BadRequestException, ValueError):
+                raise endpoints.BadRequestException('Invalid Cursor')
+        if not User.valid_name(request.user_name):
+            raise endpoints.NotFoundException('Invalid User!')
+        admission.admit('user', request.user_name)
 
+        user_key = User.key_for_name(request.user_name)
+        user, active = yield (User.get_by_name_async(request.user_name),
+                              ActiveGames.key_for_user(user_key).get_async())
         if not user:
             raise endpoints.NotFoundException('Invalid User!')
-
-        games = Game.query(Game.user == user.key).fetch()
+        if user.key != user_key:
+            active = yield ActiveGames.key_for_user(user.key).get_async()
+        if not active or not active.complete:
+            active = yield ActiveGames.reconcile_async(user.key)
+
+        ordered = sorted(active.games, key=lambda key: key.pairs())
+        start = 0
+        if after:
+            start = bisect_right([key.pairs() for key in ordered],
+                                 after.pairs())
+        keys = ordered[start:start + page_size]
+        more = start + page_size < len(ordered)
+        cursor = keys[-1].urlsafe() if more else None
         # Checks if the user has any games
-        game_length = len(games)
-        count = 0
-        if games:
-            for game in games:
-                if game.game_over is True:
-                    count += 1
-
-            if game_length == count:
+        if not keys and not request.cursor:
+            any_game = yield Game.query(Game.user == user.key).get_async(
+                keys_only=True)
+            if any_game:
                 raise endpoints.NotFoundException('Completed all games!')
-
-            else:
-                # Iterates through games and checks if game_over == False
-                # Shows only games that are not finished
-                return UserActiveGamesForms(
-                    items=[game.active_form('Time to make a move')
-                            for game in games if game.game_over is False]
-                )
-        else:
             raise endpoints.NotFoundException('Game not found!')
 
+        # Shows only games that are not finished
+        games = yield cache.get_multi_async(keys)
+        lap('lookup')
+        raise ndb.Return(UserActiveGamesForms(
+            items=[game.active_form('Time to make a move', user.name, fields)
+                   for game in games if game and game.game_over is False],
+            next_cursor=cursor,
+            more=more))
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def cancel_game(self, request):
-        """Delete a game in progress"""
-
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-
-        if game:
-            # Checks if game is already finished
-            if game.game_over is True:
-                raise endpoints.NotFoundException('Game Is Already Over')
-            else:
-                game.key.delete()
-                return StringMessage(message='Game Deleted!')
-        else:
+        """Delete a game in progress. The game is read once, inside the
+        transaction that deletes it"""
+        try:
+            game_key = decode_key(request.urlsafe_game_key, Game)
+        except ValueError:
             raise endpoints.NotFoundException('Game Does Not Exist')
+        yield _cancel_game_async(game_key)
+        lap('logic')
+        raise ndb.Return(StringMessage(message='Game Deleted!'))
 
     @endpoints.method(response_message=HighScoreForms,
                       path='leaderboard',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_high_scores(self, request):
         """Returns users high scores, Most wins"""
-        scores = Score.query().order(-Score.victories).fetch(limit=5)
-        if not scores:
+        board = yield Leaderboard.get_board_async()
+        lap('lookup')
+        entries = board.by_victories[:settings.LEADERBOARD_SIZE]
+        if not entries:
             raise endpoints.NotFoundException('No Scores Available')
-        return HighScoreForms(items=[score.high_scores() for score in scores])
+        raise ndb.Return(HighScoreForms(items=[entry.high_score_form()
+                                               for entry in entries]))
 
     @endpoints.method(response_message=UserRankingForms,
                       path='ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_user_rankings(self, request):
         """Returns users ranking, Percentage of Wins"""
-        scores = Score.query().order(-Score.percentage).fetch(limit=5)
-        if not scores:
+        board = yield Leaderboard.get_board_async()
+        lap('lookup')
+        entries = board.by_percentage[:settings.LEADERBOARD_SIZE]
+        if not entries:
             raise endpoints.NotFoundException('No Scores Available')
-        return UserRankingForms(items=[score.user_rankings()
-                                for score in scores])
+        raise ndb.Return(UserRankingForms(items=[entry.user_ranking_form()
+                                                 for entry in entries]))
+
+    @endpoints.method(request_message=USER_STATS_REQUEST,
+                      response_message=StatsForm,
+                      path='user/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @instrumented
+    @ndb.synctasklet
+    def get_user_stats(self, request):
+        """Returns a User's wins, losses, average attempts to win and games
+        in progress, as of the last stats rollup"""
+        if not User.valid_name(request.user_name):
+            raise endpoints.NotFoundException('User Does Not Exist')
+        admission.admit('user', request.user_name)
+        user_key = User.key_for_name(request.user_name)
+        user, score = yield (User.get_by_name_async(request.user_name),
+                             Score.key_for_user(user_key).get_async())
+        if not user:
+            raise endpoints.NotFoundException('User Does Not Exist')
+        if user.key != user_key:
+            score = yield Score.key_for_user(user.key).get_async()
+        lap('lookup')
+        score = score or Score.for_user(user.key)
+        raise ndb.Return(score.stats_form(user.name))
+
+    @endpoints.method(response_message=StatsForm,
+                      path='stats',
+                      name='get_game_stats',
+                      http_method='GET')
+    @instrumented
+    @ndb.synctasklet
+    def get_game_stats(self, request):
+        """Returns wins, losses, average attempts to win and games in
+        progress over every player, as of the last stats rollup"""
+        stats = yield GlobalStats.stats_key().get_async()
+        lap('lookup')
+        stats = stats or GlobalStats(key=GlobalStats.stats_key())
+        raise ndb.Return(stats.stats_form())
 
     @endpoints.method(request_message=UserGameForm,
                       response_message=HistoryGameForms,
                       path='history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_game_history(self, request):
-        """Returns all users game history"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns all users game history. Finished games are served from
+        their snapshots, only games without one are loaded and rendered.
+        Finished games from before snapshots get theirs written the first
+        time they are rendered here. Set compact or list the wanted board
+        fields to shrink the response"""
+        fields = _form_fields(request)
+        admission.admit('user', request.user_name)
+        user, page = yield _user_page_async(
+            request, lambda user_key: Game.query(Game.user == user_key))
         if not user:
             raise endpoints.NotFoundException('User Does Not Exist')
-        games = Game.query(Game.user == user.key).fetch()
-        return HistoryGameForms(items=[game.history_form() for game in games])
-
-
-api = endpoints.api_server([Battleship])
+        keys, cursor, more = page
+        snapshots = yield ndb.get_multi_async(
+            [GameSnapshot.key_for_game(key) for key in keys])
+        unsaved = [key for key, snapshot in zip(keys, snapshots)
+                   if not snapshot]
+        loaded = yield cache.get_multi_async(unsaved)
+        games = dict(zip(unsaved, loaded))
+        lap('lookup')
+        items = []
+        backfill = []
+        for key, snapshot in zip(keys, snapshots):
+            game = games.get(key)
+            if not snapshot and game and game.game_over:
+                snapshot = GameSnapshot.for_game(game)
+                backfill.append(snapshot)
+            if snapshot:
+                items.append(snapshot.history_form(fields))
+            elif game:
+                items.append(game.history_form(fields))
+        if backfill:
+            # Not waited for here, api is wrapped in ndb.toplevel, which
+            # waits for the put before the request ends
+            ndb.put_multi_async(backfill)
+        raise ndb.Return(HistoryGameForms(items=items,
+                                          next_cursor=cursor,
+                                          more=more))
+
+
+# toplevel waits for the cache deletes left pending by each request
+api = ndb.toplevel(endpoints.api_server([Battleship]))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""bench_api.py - Load test for the Battleship endpoints and the Game form
+builders, run against the App Engine testbed stubs.
+
+The workload creates users, starts games, plays every game to completion and
+reads the list and leaderboard endpoints along the way. For each endpoint it
+reports requests per second, latency percentiles and datastore/memcache RPCs
+per request. Results can be saved and compared against a saved baseline:
+
+    python benchmarks/bench_api.py --sdk ~/google_appengine \\
+        --output baseline.json
+    python benchmarks/bench_api.py --sdk ~/google_appengine \\
+        --baseline baseline.json
+
+The process exits with status 1 when a compared metric regressed by more
+than --tolerance."""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Metrics compared against a baseline, lower is better for all of them
+COMPARED = ('p50_ms', 'p99_ms', 'datastore_rpcs')
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and the app on sys.path"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def activate_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+class RpcCounter(object):
+    """Counts API proxy calls per service while a label is active"""
+
+    def __init__(self):
+        self.label = None
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_rpc_counter', self._hook)
+
+    def _hook(self, service, call, request, response):
+        if self.label:
+            self.counts[self.label][service] += 1
+
+
+class Recorder(object):
+    """Runs endpoint calls as separate requests and records their latency"""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def call(self, name, method, request):
+        from google.appengine.ext import ndb
+        import endpoints
+
+        # Every endpoint call is a fresh request with its own ndb context,
+        # like api.api gives it
+        self.counter.label = name
+        start = time.time()
+        try:
+            return ndb.toplevel(method)(request)
+        except endpoints.ServiceException:
+            self.errors[name] += 1
+        finally:
+            self.latencies[name].append(time.time() - start)
+            self.counter.label = None
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def run_workload(recorder, users, games_per_user, attempts):
+    import api
+    from protorpc import message_types
+
+    service = api.Battleship()
+    void = message_types.VoidMessage()
+    names = ['bench-user-{}'.format(i) for i in range(users)]
+
+    for name in names:
+        recorder.call('create_user', service.create_user,
+                      api.USER_REQUEST.combined_message_class(
+                          user_name=name,
+                          email='{}@example.com'.format(name)))
+
+    games = []
+    for name in names:
+        for _ in range(games_per_user):
+            form = recorder.call('new_game', service.new_game,
+                                 api.NEW_GAME_REQUEST.combined_message_class(
+                                     user_name=name, attempts=attempts))
+            if form:
+                cells = random.sample(range(1, 26), 25)
+                games.append((name, form.urlsafe_key, cells))
+
+    # Interleave the games the way concurrent players would
+    while games:
+        name, urlsafe_key, cells = games.pop(random.randrange(len(games)))
+        form = recorder.call('make_move', service.make_move,
+                             api.MAKE_MOVE_REQUEST.combined_message_class(
+                                 urlsafe_game_key=urlsafe_key,
+                                 guess=cells.pop()))
+        if form and not form.game_over:
+            games.append((name, urlsafe_key, cells))
+
+        if random.random() < 0.1:
+            request = api.UserGameForm(user_name=name)
+            recorder.call('get_user_games', service.get_user_games, request)
+        if random.random() < 0.05:
+            recorder.call('get_high_scores', service.get_high_scores, void)
+            recorder.call('get_user_rankings', service.get_user_rankings,
+                          void)
+
+    for name in names:
+        recorder.call('get_game_history', service.get_game_history,
+                      api.UserGameForm(user_name=name))
+        recorder.call('get_game_history_compact', service.get_game_history,
+                      api.UserGameForm(user_name=name, compact=True))
+
+
+def bench_form_builders(repeat):
+    """Times the Game form builders on an in-memory finished game and
+    measures the size of the JSON they serialize to"""
+    from google.appengine.ext import ndb
+    from protorpc import protojson
+    from models import Game, GameSnapshot, User, COMPACT_FIELDS
+
+    user = User(name='bench-forms')
+    user.put()
+    game = Game(key=ndb.Key(Game, 1), user=user.key, ship_location=13,
+                attempts_allowed=25, attempts_remaining=0, game_over=True)
+    for cell in range(1, 26):
+        game.fire(cell)
+    snapshot = GameSnapshot.for_game(game)
+    builders = {
+        'to_form': lambda: game.to_form('bench', user.name),
+        'active_form': lambda: game.active_form('bench', user.name),
+        'history_form': game.history_form,
+        'history_compact': lambda: game.history_form(COMPACT_FIELDS),
+        'history_snapshot': snapshot.history_form,
+        'snapshot_compact': lambda: snapshot.history_form(COMPACT_FIELDS),
+    }
+    results = {}
+    for name, builder in builders.items():
+        encode = lambda: protojson.encode_message(builder())
+        results[name] = {
+            'us_per_call': min(timeit.repeat(
+                builder, number=repeat, repeat=3)) / repeat * 1e6,
+            'encode_us_per_call': min(timeit.repeat(
+                encode, number=repeat, repeat=3)) / repeat * 1e6,
+            'bytes': len(encode()),
+        }
+    return results
+
+
+def summarize(recorder, counter):
+    results = {}
+    for name, latencies in recorder.latencies.items():
+        calls = len(latencies)
+        rpcs = counter.counts[name]
+        results[name] = {
+            'calls': calls,
+            'errors': recorder.errors[name],
+            'rps': calls / sum(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'datastore_rpcs': rpcs['datastore_v3'] / float(calls),
+            'memcache_rpcs': rpcs['memcache'] / float(calls),
+        }
+    return results
+
+
+def print_report(results, forms):
+    header = '{:<24} {:>6} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9}'
+    print(header.format('endpoint', 'calls', 'rps', 'p50 ms', 'p90 ms',
+                        'p99 ms', 'ds rpcs', 'mc rpcs'))
+    row = '{:<24} {:>6} {:>8.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>9.2f} {:>9.2f}'
+    for name in sorted(results):
+        r = results[name]
+        print(row.format(name, r['calls'], r['rps'], r['p50_ms'],
+                         r['p90_ms'], r['p99_ms'], r['datastore_rpcs'],
+                         r['memcache_rpcs']))
+    print('')
+    for name in sorted(forms):
+        f = forms[name]
+        print('{:<18} {:>8.2f} us/call {:>8.2f} us/encode {:>6} bytes'.format(
+            name, f['us_per_call'], f['encode_us_per_call'], f['bytes']))
+
+
+def compare(results, baseline, tolerance):
+    """Prints metrics that regressed against the baseline. Returns True
+    when nothing regressed by more than tolerance"""
+    ok = True
+    for name in sorted(results):
+        before = baseline.get(name)
+        if not before:
+            continue
+        for metric in COMPARED:
+            old, new = before[metric], results[name][metric]
+            if old and (new - old) / old > tolerance:
+                ok = False
+                print('REGRESSION {} {}: {:.2f} -> {:.2f}'.format(
+                    name, metric, old, new))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK', ''),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--games', type=int, default=5,
+                        help='games started per user')
+    parser.add_argument('--attempts', type=int, default=10)
+    parser.add_argument('--form-repeat', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=410)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='compare with saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression, default 0.2')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the admission rate limits on')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    import settings
+    # The workload plays far faster than the per user and game limits allow
+    settings.ADMISSION_ENABLED = args.rate_limits
+    random.seed(args.seed)
+    bed = activate_testbed()
+    try:
+        counter = RpcCounter()
+        counter.install()
+        recorder = Recorder(counter)
+        run_workload(recorder, args.users, args.games, args.attempts)
+        results = summarize(recorder, counter)
+        forms = bench_form_builders(args.form_repeat)
+    finally:
+        bed.deactivate()
+
+    print_report(results, forms)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'endpoints': results, 'forms': forms}, f,
+                      indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline['endpoints'], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
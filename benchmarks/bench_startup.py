@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""bench_startup.py - Cold start benchmark for the api and main WSGI apps,
+run against the App Engine testbed stubs.
+
+Every sample runs in a fresh Python process, the way a new instance starts.
+It measures how long importing the app module takes and how long the first
+request after it takes. The warm scenario sends the warmup request to
+main.app first and then measures the api the same way:
+
+    python benchmarks/bench_startup.py --sdk ~/google_appengine --runs 10
+
+The SDK path setup and the testbed stubs are not part of the measured
+time."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench_api import activate_testbed, percentile, setup_sdk
+
+SCENARIOS = ('api', 'main', 'warm')
+
+
+def timed(function):
+    start = time.time()
+    result = function()
+    return result, (time.time() - start) * 1000
+
+
+def api_request():
+    import api
+    import endpoints
+
+    service = api.Battleship()
+    try:
+        service.create_user(api.USER_REQUEST.combined_message_class(
+            user_name='startup', email='startup@example.com'))
+    except endpoints.ServiceException:
+        pass
+
+
+def main_request(path):
+    import main
+    import webapp2
+
+    return webapp2.Request.blank(path).get_response(main.app).status_int
+
+
+def run_child(scenario):
+    """Runs one sample in this process and returns its timings in ms"""
+    sample = {}
+    if scenario == 'warm':
+        _, sample['main_import_ms'] = timed(lambda: __import__('main'))
+        _, sample['warmup_ms'] = timed(lambda: main_request('/_ah/warmup'))
+        scenario = 'api'
+    if scenario == 'api':
+        _, sample['import_ms'] = timed(lambda: __import__('api'))
+        _, sample['first_request_ms'] = timed(api_request)
+    else:
+        _, sample['import_ms'] = timed(lambda: __import__('main'))
+        _, sample['first_request_ms'] = timed(
+            lambda: main_request('/crons/rebuild_leaderboard'))
+    _, sample['second_request_ms'] = timed(
+        api_request if scenario == 'api'
+        else lambda: main_request('/crons/rebuild_leaderboard'))
+    return sample
+
+
+def run_samples(sdk, scenario, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--sdk', sdk,
+             '--child', scenario])
+        samples.append(json.loads(output.splitlines()[-1]))
+    return samples
+
+
+def summarize(samples):
+    return dict((metric, {'p50': percentile([s[metric] for s in samples], 50),
+                          'max': max(s[metric] for s in samples)})
+                for metric in samples[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK', ''),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='fresh processes per scenario')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        setup_sdk(args.sdk)
+        bed = activate_testbed()
+        try:
+            sample = run_child(args.child)
+        finally:
+            bed.deactivate()
+        print(json.dumps(sample))
+        return
+
+    results = dict((scenario,
+                    summarize(run_samples(args.sdk, scenario, args.runs)))
+                   for scenario in SCENARIOS)
+    for scenario in SCENARIOS:
+        print(scenario)
+        for metric, values in sorted(results[scenario].items()):
+            print('  {:<20} p50 {:>9.2f} ms   max {:>9.2f} ms'.format(
+                metric, values['p50'], values['max']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
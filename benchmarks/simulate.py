@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""simulate.py - Offline simulator for Battleship guessing strategies, built
+on the game engine the endpoints play.
+
+Games are played in memory across a pool of processes. For every strategy
+it reports the distribution of moves needed to sink every ship and the win
+rate at each attempts setting. Strategies never see the attempts budget, so
+a game with a budget of n attempts is won exactly when its strategy needs
+at most n moves, and one run covers every attempts setting:
+
+    python benchmarks/simulate.py --games 1000000 --attempts 10 15 20
+
+Strategies that fix their guessing order before the game starts are scored
+a batch of boards at a time with NumPy arrays when NumPy is installed.
+--engine-only plays every game move by move through engine.play instead,
+and --check plays a sample both ways on the same boards and orders and
+exits with status 1 if they disagree."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from board import Board
+import engine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Strategy(object):
+    """Picks the next cell to shoot at from the outcomes seen so far. The
+    order it hunts in is drawn before the game starts: cells with a lower
+    priority first, cells of equal priority in a random order"""
+    # Fixed strategies never change their order during a game
+    fixed = True
+
+    def __init__(self, width, height, rng, order=None):
+        self.width = width
+        self.height = height
+        self.cells = width * height
+        self.order = order or self.make_order(rng)
+        self.played = 0
+
+    @staticmethod
+    def priority(width, height):
+        """Returns the priority of every cell"""
+        return [0] * (width * height)
+
+    def make_order(self, rng):
+        priority = self.priority(self.width, self.height)
+        return sorted(range(1, self.cells + 1),
+                      key=lambda cell: priority[cell - 1] + rng.random())
+
+    def next_cell(self):
+        cell = self.order[self.played]
+        self.played += 1
+        return cell
+
+    def observe(self, cell, outcome):
+        pass
+
+
+class Random(Strategy):
+    """Shoots at every cell in a random order"""
+
+
+class Sequential(Strategy):
+    """Shoots row by row"""
+
+    @staticmethod
+    def priority(width, height):
+        return list(range(width * height))
+
+
+class Parity(Strategy):
+    """Shoots at one colour of the checkerboard first, then at the other.
+    Ships longer than one cell always cover both colours"""
+
+    @staticmethod
+    def priority(width, height):
+        return [(row + col) & 1 for row in range(height)
+                for col in range(width)]
+
+
+class HuntTarget(Parity):
+    """Hunts like Parity and, after a hit that didn't sink the ship, shoots
+    the neighbours of the hit cell first"""
+    fixed = False
+
+    def __init__(self, width, height, rng, order=None):
+        Parity.__init__(self, width, height, rng, order)
+        self.shot = set()
+        self.targets = []
+
+    def next_cell(self):
+        while self.targets:
+            cell = self.targets.pop()
+            if cell not in self.shot:
+                break
+        else:
+            cell = self.order[self.played]
+            while cell in self.shot:
+                self.played += 1
+                cell = self.order[self.played]
+        self.shot.add(cell)
+        return cell
+
+    def observe(self, cell, outcome):
+        if outcome != engine.HIT:
+            return
+        row, col = divmod(cell - 1, self.width)
+        for r, c in ((row - 1, col), (row + 1, col),
+                     (row, col - 1), (row, col + 1)):
+            if 0 <= r < self.height and 0 <= c < self.width:
+                self.targets.append(r * self.width + c + 1)
+
+
+STRATEGIES = {
+    'sequential': Sequential,
+    'random': Random,
+    'parity': Parity,
+    'hunt': HuntTarget,
+}
+
+
+def play_engine(strategy, match):
+    """Plays a Match to the end through engine.play. Returns the number of
+    moves made"""
+    moves = 0
+    while not match.game_over:
+        cell = strategy.next_cell()
+        strategy.observe(cell, engine.play(match, cell))
+        moves += 1
+    return moves
+
+
+def run_engine(name, width, height, ships, games, rng):
+    """Plays games move by move. Returns how many needed each number of
+    moves"""
+    counts = [0] * (width * height + 1)
+    cells = width * height
+    for _ in range(games):
+        match = engine.Match.new(cells, width, height, ships, rng)
+        strategy = STRATEGIES[name](width, height, rng)
+        counts[play_engine(strategy, match)] += 1
+    return counts
+
+
+def _occupancy(boards, cells):
+    """Returns a games x cells boolean array of the ship cells"""
+    occupied = numpy.zeros((len(boards), cells), dtype=bool)
+    for index, board in enumerate(boards):
+        for ship in board.ships:
+            occupied[index, numpy.array(ship) - 1] = True
+    return occupied
+
+
+def _ranks(name, width, height, games, np_rng):
+    """Draws the orders of a batch of games the way make_order does.
+    Returns a games x cells array of the move on which each cell is shot,
+    counted from 0"""
+    priority = numpy.array(STRATEGIES[name].priority(width, height))
+    keys = priority + np_rng.random_sample((games, width * height))
+    return keys.argsort(axis=1).argsort(axis=1)
+
+
+def run_numpy(name, width, height, ships, games, rng, np_rng):
+    """Scores a fixed strategy on a batch of boards at once. A game ends on
+    the move that shoots its last ship cell. Returns how many needed each
+    number of moves, and the boards, ranks and moves of every game"""
+    cells = width * height
+    boards = [engine.place_ships(width, height, ships, rng)
+              for _ in range(games)]
+    ranks = _ranks(name, width, height, games, np_rng)
+    needed = numpy.where(_occupancy(boards, cells), ranks,
+                         -1).max(axis=1) + 1
+    counts = numpy.bincount(needed, minlength=cells + 1)
+    return counts.tolist(), boards, ranks, needed
+
+
+def check(name, width, height, ships, games, seed):
+    """Plays the same boards and orders through the engine and through
+    NumPy. Returns the number of games where they disagree"""
+    rng = random.Random(seed)
+    _, boards, ranks, needed = run_numpy(
+        name, width, height, ships, games, rng,
+        numpy.random.RandomState(seed))
+    wrong = 0
+    for board, rank, moves in zip(boards, ranks, needed):
+        order = (rank.argsort() + 1).tolist()
+        strategy = STRATEGIES[name](width, height, rng, order)
+        match = engine.Match(Board(width, height, board.ships),
+                             width * height)
+        if play_engine(strategy, match) != moves:
+            wrong += 1
+    return wrong
+
+
+def run_chunk(task):
+    """Runs one chunk of games in a worker process"""
+    name, width, height, ships, games, seed, engine_only = task
+    rng = random.Random(seed)
+    if numpy and not engine_only and STRATEGIES[name].fixed:
+        return name, run_numpy(name, width, height, ships, games, rng,
+                               numpy.random.RandomState(seed))[0]
+    return name, run_engine(name, width, height, ships, games, rng)
+
+
+def summarize(counts, attempts):
+    games = sum(counts)
+    total = 0
+    cumulative = []
+    for moves, count in enumerate(counts):
+        total += count
+        cumulative.append(total)
+
+    def percentile(pct):
+        target = pct / 100.0 * games
+        return next(moves for moves, total in enumerate(cumulative)
+                    if total >= target)
+
+    return {
+        'games': games,
+        'mean_moves': sum(moves * count
+                          for moves, count in enumerate(counts)) /
+        float(games),
+        'p50_moves': percentile(50),
+        'p90_moves': percentile(90),
+        'win_rate': dict((str(n), cumulative[n] / float(games))
+                         for n in attempts),
+        'moves_needed': counts,
+    }
+
+
+def print_report(results, attempts):
+    header = '{:<12} {:>10} {:>8} {:>6} {:>6}' + ' {:>7}' * len(attempts)
+    print(header.format('strategy', 'games', 'mean', 'p50', 'p90',
+                        *['win@{}'.format(n) for n in attempts]))
+    row = '{:<12} {:>10} {:>8.2f} {:>6} {:>6}' + ' {:>7.3f}' * len(attempts)
+    for name in sorted(results):
+        r = results[name]
+        print(row.format(name, r['games'], r['mean_moves'], r['p50_moves'],
+                         r['p90_moves'],
+                         *[r['win_rate'][str(n)] for n in attempts]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=100000,
+                        help='games played per strategy')
+    parser.add_argument('--width', type=int, default=5)
+    parser.add_argument('--height', type=int, default=5)
+    parser.add_argument('--ships', type=int, nargs='+', default=[1],
+                        help='ship lengths, default one ship of 1 cell')
+    parser.add_argument('--attempts', type=int, nargs='+',
+                        help='attempts settings to report win rates for')
+    parser.add_argument('--strategies', nargs='+', choices=sorted(STRATEGIES),
+                        default=sorted(STRATEGIES))
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk', type=int, default=10000,
+                        help='games per task handed to a process')
+    parser.add_argument('--seed', type=int, default=410)
+    parser.add_argument('--engine-only', action='store_true',
+                        help='play every game through engine.play')
+    parser.add_argument('--check', type=int, metavar='GAMES',
+                        help='compare NumPy and engine results first')
+    parser.add_argument('--output', help='save the results as JSON')
+    args = parser.parse_args()
+
+    cells = args.width * args.height
+    try:
+        engine.check_setup(args.width, args.height, cells, args.ships)
+    except engine.RuleError as e:
+        parser.error(str(e))
+    attempts = sorted(set(args.attempts or
+                          [cells // 4, cells // 2, cells * 3 // 4, cells]))
+    if not all(1 <= n <= cells for n in attempts):
+        parser.error('Attempts need to be between 1 and {}'.format(cells))
+
+    if args.check:
+        if not numpy:
+            parser.error('--check needs NumPy')
+        for name in args.strategies:
+            if STRATEGIES[name].fixed:
+                wrong = check(name, args.width, args.height, args.ships,
+                              args.check, args.seed)
+                print('check {}: {} of {} games differ'.format(
+                    name, wrong, args.check))
+                if wrong:
+                    sys.exit(1)
+
+    tasks = []
+    for name in args.strategies:
+        for start in range(0, args.games, args.chunk):
+            tasks.append((name, args.width, args.height, args.ships,
+                          min(args.chunk, args.games - start),
+                          args.seed + len(tasks), args.engine_only))
+
+    start = time.time()
+    counts = dict((name, [0] * (cells + 1)) for name in args.strategies)
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for name, chunk in pool.imap_unordered(run_chunk, tasks):
+            counts[name] = [a + b for a, b in zip(counts[name], chunk)]
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - start
+
+    results = dict((name, summarize(counts[name], attempts))
+                   for name in args.strategies)
+    print_report(results, attempts)
+    played = args.games * len(args.strategies)
+    print('')
+    print('{} games in {:.1f}s, {:.0f} games/s, NumPy {}'.format(
+        played, seconds, played / seconds,
+        'off' if args.engine_only or not numpy else 'on'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
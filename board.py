@@ -0,0 +1,123 @@
+"""board.py - Board engine shared by the Game model and its form builders.
+
+A board of width x height cells keeps the cells that have been shot at as a
+packed bit array, one bit per cell, and the cells of every ship. Shot, hit
+and sunk checks are constant time, and the board is rendered a byte of the
+bit array (eight cells) at a time from a precomputed table. Cells are
+numbered from 1, row by row."""
+
+import random
+
+MAX_SIDE = 100
+MAX_CELLS = MAX_SIDE * MAX_SIDE
+
+# Attempts to find a free spot for each ship before giving up
+PLACEMENT_TRIES = 100
+
+# _BYTE_CELLS[byte] renders the eight cells whose shot bits make up byte
+_BYTE_CELLS = tuple(
+    ''.join('X' if byte >> bit & 1 else 'O' for bit in range(8))
+    for byte in range(256))
+
+
+class Board(object):
+    """Shots and ships of one board"""
+
+    def __init__(self, width, height, ships, shots=None):
+        self.width = width
+        self.height = height
+        self.cells = width * height
+        self.ships = ships
+        self.shots = bytearray(shots or (self.cells + 7) // 8)
+        self._ship_at = dict((cell, index)
+                             for index, ship in enumerate(ships)
+                             for cell in ship)
+        self._afloat = [sum(1 for cell in ship if not self.is_shot(cell))
+                        for ship in ships]
+
+    @classmethod
+    def place(cls, width, height, lengths, rng=random):
+        """Returns a new Board with ships of the given lengths placed at
+        random, horizontally or vertically, without overlapping. Raises
+        ValueError when the ships can't all be placed"""
+        occupied = set()
+        ships = []
+        for length in sorted(lengths, reverse=True):
+            orientations = []
+            if length <= width:
+                orientations.append((1, height, width - length + 1))
+            if length <= height and length > 1:
+                orientations.append((width, height - length + 1, width))
+            if not orientations:
+                raise ValueError('Ship of length {} does not fit'.format(
+                    length))
+            for _ in range(PLACEMENT_TRIES):
+                step, rows, cols = rng.choice(orientations)
+                start = rng.randrange(rows) * width + rng.randrange(cols) + 1
+                ship = range(start, start + step * length, step)
+                if not occupied.intersection(ship):
+                    occupied.update(ship)
+                    ships.append(ship)
+                    break
+            else:
+                raise ValueError('Could not place every ship')
+        return cls(width, height, ships)
+
+    @classmethod
+    def from_legacy(cls, width, height, ship_location, guesses):
+        """Returns the Board of a game saved before ships and shots were
+        kept, which had a single ship of one cell at ship_location"""
+        board = cls(width, height, [[ship_location]])
+        for guess in guesses:
+            board.fire(guess)
+        return board
+
+    def is_shot(self, cell):
+        index = cell - 1
+        return self.shots[index >> 3] >> (index & 7) & 1 == 1
+
+    def fire(self, cell):
+        """Records a shot. Returns the index of the ship that was hit, or
+        None for a miss"""
+        if not self.is_shot(cell):
+            index = cell - 1
+            self.shots[index >> 3] |= 1 << (index & 7)
+            ship = self._ship_at.get(cell)
+            if ship is not None:
+                self._afloat[ship] -= 1
+        return self._ship_at.get(cell)
+
+    def is_sunk(self, ship):
+        return self._afloat[ship] == 0
+
+    def all_sunk(self):
+        return not any(self._afloat)
+
+    def hit_mask(self):
+        """Returns the ship cells that were shot at as a bit array laid out
+        like shots"""
+        mask = bytearray(len(self.shots))
+        for cell in self._ship_at:
+            if self.is_shot(cell):
+                index = cell - 1
+                mask[index >> 3] |= 1 << (index & 7)
+        return mask
+
+    def render(self, reveal=False):
+        """Returns the board as one character per cell: 'X' for cells shot
+        at and 'O' for the rest. With reveal, ship cells that were hit are
+        drawn as 'S'"""
+        board = ''.join([_BYTE_CELLS[byte] for byte in self.shots])
+        board = board[:self.cells]
+        if reveal:
+            board = bytearray(board)
+            for cell in self._ship_at:
+                if self.is_shot(cell):
+                    board[cell - 1] = 'S'
+            board = str(board)
+        return board
+
+    def rows(self, board):
+        """Splits a rendered board into space separated row strings"""
+        return [' '.join(board[start:start + self.width])
+                for start in range(0, self.cells, self.width)]
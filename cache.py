@@ -0,0 +1,116 @@
+"""cache.py - Memcache read-through cache for Game entities. Each entry holds
+the entity together with its rendered board, keyed by the game's urlsafe
+key. Entries are dropped by the Game put and delete hooks. Keys found
+missing are left to the negative cache in utils, so they cost no memcache
+or datastore call while remembered."""
+
+import threading
+from google.appengine.ext import ndb
+
+import settings
+from utils import decode_key, forget_missing, is_missing, remember_missing
+
+NAMESPACE = 'games'
+
+# Placeholder of an entry being filled, and the seconds it is kept when the
+# request filling it dies
+_LOCKED = 0
+LOCK_TIME = 32
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _count(hits=0, misses=0):
+    with _lock:
+        _stats['hits'] += hits
+        _stats['misses'] += misses
+
+
+def stats():
+    """Returns this instance's cache hit and miss counters"""
+    with _lock:
+        return dict(_stats)
+
+
+def _load(cached):
+    """Returns the cached Game with its rendered board attached"""
+    entity, board = cached
+    entity.cache_board(board)
+    return entity
+
+
+def _entry(game):
+    return game, game.render_board()
+
+
+def get_by_urlsafe_cached(urlsafe, model):
+    """Read-through version of utils.get_by_urlsafe"""
+    key = decode_key(urlsafe, model)
+    return get_multi_async([key]).get_result()[0]
+
+
+@ndb.tasklet
+def get_multi_async(keys):
+    """Read-through version of ndb.get_multi_async for Game keys. Returns
+    the entities in the order of keys, with None for missing ones. The
+    memcache reads and writes go through the ndb context, which batches
+    them into one call each.
+
+    A miss is filled the way ndb fills its own cache: a placeholder claims
+    the entry before the datastore read and the entity replaces it with a
+    compare-and-set. A write committed in between deletes the placeholder,
+    so the fill fails instead of caching the Game read before the write"""
+    ctx = ndb.get_context()
+    known = [key for key in keys if not is_missing(key)]
+    urlsafes = [key.urlsafe() for key in known]
+    entries = yield [ctx.memcache_get(urlsafe, namespace=NAMESPACE)
+                     for urlsafe in urlsafes]
+    cached = dict((urlsafe, entry) for urlsafe, entry
+                  in zip(urlsafes, entries) if isinstance(entry, tuple))
+    missing = [key for key, urlsafe in zip(known, urlsafes)
+               if urlsafe not in cached]
+    _count(hits=len(known) - len(missing), misses=len(missing))
+
+    # Entries holding a placeholder are being filled by another request
+    free = [urlsafe for urlsafe, entry in zip(urlsafes, entries)
+            if entry is None]
+    claims = yield [ctx.memcache_add(urlsafe, _LOCKED, time=LOCK_TIME,
+                                     namespace=NAMESPACE)
+                    for urlsafe in free]
+    claimed = set(urlsafe for urlsafe, ok in zip(free, claims) if ok)
+    if claimed:
+        # Reads the placeholders again to get their compare-and-set ids
+        yield [ctx.memcache_gets(urlsafe, namespace=NAMESPACE)
+               for urlsafe in claimed]
+
+    entities = yield ndb.get_multi_async(missing)
+    loaded = dict((key, entity) for key, entity in
+                  zip(missing, entities) if entity)
+    remember_missing(key for key in missing if key not in loaded)
+    fills = [ctx.memcache_cas(key.urlsafe(), _entry(entity),
+                              time=settings.GAME_CACHE_TTL,
+                              namespace=NAMESPACE)
+             for key, entity in loaded.iteritems()
+             if key.urlsafe() in claimed]
+    released = [ctx.memcache_delete(key.urlsafe(), namespace=NAMESPACE)
+                for key in missing
+                if key not in loaded and key.urlsafe() in claimed]
+    if fills or released:
+        yield fills + released
+
+    raise ndb.Return([_load(cached[key.urlsafe()])
+                      if key.urlsafe() in cached else loaded.get(key)
+                      for key in keys])
+
+
+def invalidate(key):
+    """Drops a Game from the cache. Inside a transaction the entry is only
+    dropped once the transaction commits. The delete goes through the ndb
+    context, so the deletes of a put_multi are batched into one call. The
+    WSGI apps are wrapped in ndb.toplevel, which waits for them before the
+    request ends"""
+    forget_missing(key)
+    ndb.get_context().call_on_commit(
+        lambda: ndb.get_context().memcache_delete(key.urlsafe(),
+                                                  namespace=NAMESPACE))
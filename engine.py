@@ -0,0 +1,108 @@
+"""engine.py - The Battleship rules, free of any datastore or endpoints code.
+
+The endpoints play Game entities through these functions, and anything
+else with a board, attempts_remaining, game_over and a fire(cell) method
+can be played the same way. Match is such a game held only in memory, which
+benchmarks/simulate.py uses to play games offline."""
+
+import random
+
+from board import Board, MAX_SIDE
+import settings
+
+# Outcomes of a guess, as shown to the player
+WON = 'You win!'
+LOST = 'Game over!'
+MISS = 'You Missed!'
+SUNK = 'You sunk a ship!'
+HIT = 'You hit a ship!'
+
+
+class RuleError(ValueError):
+    """A game setup or move the rules don't allow"""
+
+
+class InvalidAttempts(RuleError):
+    """An attempts budget that doesn't fit the board"""
+
+
+class InvalidMove(RuleError):
+    """A guess that can't be played on the board"""
+
+
+def check_setup(width, height, attempts, ship_lengths):
+    """Validates the board, attempts and ships of a new game. Raises
+    InvalidAttempts for a bad attempts budget and RuleError for the rest"""
+    if not (1 <= width <= MAX_SIDE and 1 <= height <= MAX_SIDE):
+        raise RuleError('Width and height need to be between 1 and {}'.format(
+            MAX_SIDE))
+    cells = width * height
+    if attempts < 1:
+        raise InvalidAttempts('Attempts Remaining needs to be more than 0')
+    if attempts > cells:
+        raise InvalidAttempts(
+            'Attempts Remaining needs to be at most {}'.format(cells))
+    if len(ship_lengths) > settings.MAX_SHIPS:
+        raise RuleError('A game can have at most {} ships'.format(
+            settings.MAX_SHIPS))
+    if min(ship_lengths) < 1 or sum(ship_lengths) > cells:
+        raise RuleError('Invalid ship lengths')
+
+
+def place_ships(width, height, ship_lengths, rng=random):
+    """Returns a new Board with the ships placed at random. Raises
+    ValueError when they can't all be placed"""
+    return Board.place(width, height, ship_lengths, rng)
+
+
+def play(game, guess):
+    """Applies a guess to a game that isn't over yet and sets game_over when
+    it ends the game. Returns the outcome, one of WON, LOST, MISS, SUNK and
+    HIT. Raises InvalidMove for a guess off the board or already made"""
+    board = game.board
+    # Checks if game is within limits of the board
+    if guess < 1 or guess > board.cells:
+        raise InvalidMove('Invalid Move, Outside Grid Boundaries')
+
+    # Checks for duplicate guesses
+    if board.is_shot(guess):
+        raise InvalidMove('Already Guessed This Number')
+
+    game.attempts_remaining -= 1
+    ship = game.fire(guess)
+
+    # Every ship has been sunk
+    if board.all_sunk():
+        game.game_over = True
+        return WON
+    # Last turn, Game Over
+    if game.attempts_remaining == 0:
+        game.game_over = True
+        return LOST
+    if ship is None:
+        return MISS
+    if board.is_sunk(ship):
+        return SUNK
+    return HIT
+
+
+class Match(object):
+    """A game held in memory: a Board and its attempts budget"""
+    __slots__ = ('board', 'attempts_remaining', 'game_over')
+
+    def __init__(self, board, attempts):
+        self.board = board
+        self.attempts_remaining = attempts
+        self.game_over = False
+
+    @classmethod
+    def new(cls, attempts, width=5, height=5, ship_lengths=(1,),
+            rng=random):
+        """Returns a new Match with its ships placed at random"""
+        return cls(place_ships(width, height, ship_lengths, rng), attempts)
+
+    def fire(self, cell):
+        return self.board.fire(cell)
+
+    def is_won(self):
+        return self.board.all_sunk()
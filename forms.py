@@ -6,19 +6,28 @@ class GameForm(messages.Message):
     urlsafe_key = messages.StringField(1, required=True)
     attempts_remaining = messages.IntegerField(2, required=True)
     guesses = messages.IntegerField(3, repeated=True)
-    rowA = messages.StringField(4, required=True)
-    rowB = messages.StringField(5, required=True)
-    rowC = messages.StringField(6, required=True)
-    rowD = messages.StringField(7, required=True)
-    rowE = messages.StringField(8, required=True)
+    rowA = messages.StringField(4)
+    rowB = messages.StringField(5)
+    rowC = messages.StringField(6)
+    rowD = messages.StringField(7)
+    rowE = messages.StringField(8)
     game_over = messages.BooleanField(9, required=True)
     message = messages.StringField(10, required=True)
     user_name = messages.StringField(11, required=True)
+    width = messages.IntegerField(12)
+    height = messages.IntegerField(13)
+    board = messages.StringField(14)
+    shots = messages.BytesField(15)
+    hits = messages.BytesField(16)
 
 
 class UserGameForm(messages.Message):
     """Input Field for retrieving user's Game History and Active Games"""
     user_name = messages.StringField(1, required=True)
+    page_size = messages.IntegerField(2)
+    cursor = messages.StringField(3)
+    compact = messages.BooleanField(4)
+    fields = messages.StringField(5, repeated=True)
 
 
 class UserActiveGamesForm(messages.Message):
@@ -26,30 +35,90 @@ class UserActiveGamesForm(messages.Message):
     urlsafe_key = messages.StringField(1, required=True)
     attempts_remaining = messages.IntegerField(2, required=True)
     guesses = messages.IntegerField(3, repeated=True)
-    rowA = messages.StringField(4, required=True)
-    rowB = messages.StringField(5, required=True)
-    rowC = messages.StringField(6, required=True)
-    rowD = messages.StringField(7, required=True)
-    rowE = messages.StringField(8, required=True)
+    rowA = messages.StringField(4)
+    rowB = messages.StringField(5)
+    rowC = messages.StringField(6)
+    rowD = messages.StringField(7)
+    rowE = messages.StringField(8)
     game_over = messages.BooleanField(9, required=True)
     message = messages.StringField(10, required=True)
     user_name = messages.StringField(11, required=True)
+    width = messages.IntegerField(12)
+    height = messages.IntegerField(13)
+    board = messages.StringField(14)
+    shots = messages.BytesField(15)
+    hits = messages.BytesField(16)
 
 
 class UserActiveGamesForms(messages.Message):
     """Used to return users game that are active"""
     items = messages.MessageField(UserActiveGamesForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    more = messages.BooleanField(3)
 
 
 class NewGameForm(messages.Message):
     """Input Field, Used to create a new game request"""
     user_name = messages.StringField(1, required=True)
     attempts = messages.IntegerField(2, default=5)
+    width = messages.IntegerField(3, default=5)
+    height = messages.IntegerField(4, default=5)
+    ships = messages.IntegerField(5, repeated=True)
+
+
+class NewGamesForm(messages.Message):
+    """Input Field, Used to create several games in one request"""
+    user_name = messages.StringField(1, required=True)
+    count = messages.IntegerField(2, required=True)
+    attempts = messages.IntegerField(3, default=5)
+    width = messages.IntegerField(4, default=5)
+    height = messages.IntegerField(5, default=5)
+    ships = messages.IntegerField(6, repeated=True)
+
+
+class GameResultForm(messages.Message):
+    """The game created for one item of a batch, or why it failed"""
+    game = messages.MessageField(GameForm, 1)
+    error = messages.StringField(2)
+
+
+class GameResultForms(messages.Message):
+    """Results of a batch game creation, one per requested game"""
+    items = messages.MessageField(GameResultForm, 1, repeated=True)
 
 
 class MakeMoveForm(messages.Message):
     """Input Field, Used to make a move in an existing game"""
     guess = messages.IntegerField(1, required=True)
+    compact = messages.BooleanField(2)
+    fields = messages.StringField(3, repeated=True)
+
+
+class MoveForm(messages.Message):
+    """Input Field, One move of a batch"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    guess = messages.IntegerField(2, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Input Field, Used to make moves across many games in one request"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """Outcome of one move of a batch, in request order"""
+    index = messages.IntegerField(1, required=True)
+    urlsafe_game_key = messages.StringField(2, required=True)
+    guess = messages.IntegerField(3, required=True)
+    message = messages.StringField(4)
+    attempts_remaining = messages.IntegerField(5)
+    game_over = messages.BooleanField(6)
+    error = messages.StringField(7)
+
+
+class MoveResultForms(messages.Message):
+    """Outcomes of a batch of moves"""
+    items = messages.MessageField(MoveResultForm, 1, repeated=True)
 
 
 class HighScoreForm(messages.Message):
@@ -74,23 +143,41 @@ class UserRankingForms(messages.Message):
     items = messages.MessageField(UserRankingForm, 1, repeated=True)
 
 
+class StatsForm(messages.Message):
+    """Game statistics of one User, or of every player"""
+    user_name = messages.StringField(1)
+    victories = messages.FloatField(2, required=True)
+    losses = messages.FloatField(3, required=True)
+    percentage = messages.FloatField(4, required=True)
+    average_attempts = messages.FloatField(5, required=True)
+    games_in_progress = messages.IntegerField(6, required=True)
+    games_abandoned = messages.IntegerField(7, required=True)
+
+
 class HistoryGameForm(messages.Message):
     """Return Users Game History"""
     attempts_remaining = messages.IntegerField(1, required=True)
     attempts_allowed = messages.IntegerField(2, required=True)
     message = messages.StringField(3, required=True)
     guesses = messages.IntegerField(4, repeated=True)
-    rowA = messages.StringField(5, required=True)
-    rowB = messages.StringField(6, required=True)
-    rowC = messages.StringField(7, required=True)
-    rowD = messages.StringField(8, required=True)
-    rowE = messages.StringField(9, required=True)
+    rowA = messages.StringField(5)
+    rowB = messages.StringField(6)
+    rowC = messages.StringField(7)
+    rowD = messages.StringField(8)
+    rowE = messages.StringField(9)
     game_over = messages.BooleanField(10, required=True)
+    width = messages.IntegerField(11)
+    height = messages.IntegerField(12)
+    board = messages.StringField(13)
+    shots = messages.BytesField(14)
+    hits = messages.BytesField(15)
 
 
 class HistoryGameForms(messages.Message):
     """Return Users Game History"""
     items = messages.MessageField(HistoryGameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    more = messages.BooleanField(3)
 
 
 class StringMessage(messages.Message):
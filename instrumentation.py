@@ -0,0 +1,107 @@
+"""instrumentation.py - Per-request RPC counts and phase timings for the
+Battleship endpoints. Every instrumented call emits one structured log line
+tagged with the endpoint name, for example:
+
+    endpoint_stats {"endpoint": "make_move", "gets": 2, "puts": 1, ...}
+
+The line also carries the instance's Game cache hit and miss counters.
+RPCs are counted by an API proxy hook that only increments a counter on the
+current request, so the instrumentation is cheap enough to leave on."""
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from google.appengine.api import apiproxy_stub_map
+
+import cache
+import settings
+
+# Datastore calls summarized under each field of the log line
+_DATASTORE_FIELDS = {
+    'Get': 'gets',
+    'Put': 'puts',
+    'Delete': 'deletes',
+    'RunQuery': 'queries',
+    'Next': 'queries',
+    'Commit': 'commits',
+}
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """RPC counts and phase timings of one endpoint call"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.rpcs = defaultdict(int)
+        self.phases = defaultdict(float)
+        self.start = self.lap_start = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.phases[phase] += now - self.lap_start
+        self.lap_start = now
+
+    def record(self, service, call):
+        if service == 'datastore_v3':
+            self.rpcs[_DATASTORE_FIELDS.get(call, 'other_datastore')] += 1
+        else:
+            self.rpcs[service] += 1
+
+    def as_dict(self):
+        stats = dict(self.rpcs)
+        stats['endpoint'] = self.endpoint
+        stats['total_ms'] = round((time.time() - self.start) * 1000, 2)
+        for phase, seconds in self.phases.items():
+            stats[phase + '_ms'] = round(seconds * 1000, 2)
+        return stats
+
+
+def _count_rpc(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.record(service, call)
+
+
+def lap(phase):
+    """Ends the current phase of the running endpoint call. Time since the
+    previous lap is added to the named phase"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.lap(phase)
+
+
+def instrumented(method):
+    """Wraps an endpoint method so its RPCs and phases are logged. Time
+    after the last lap is reported as the 'render' phase, or as 'failed'
+    when the method raised"""
+    @functools.wraps(method)
+    def wrapper(service, request):
+        if not settings.INSTRUMENTATION_ENABLED:
+            return method(service, request)
+        stats = _local.stats = RequestStats(method.__name__)
+        status = 'ok'
+        try:
+            return method(service, request)
+        except Exception, e:
+            status = e.__class__.__name__
+            raise
+        finally:
+            _local.stats = None
+            stats.lap('render' if status == 'ok' else 'failed')
+            line = stats.as_dict()
+            line['status'] = status
+            # Game cache counters of the instance since it started
+            for name, count in cache.stats().items():
+                line['instance_cache_' + name] = count
+            logging.info('endpoint_stats %s',
+                         json.dumps(line, sort_keys=True))
+    return wrapper
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'instrumentation', _count_rpc)
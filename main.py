@@ -3,29 +3,204 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 import logging
+import time
 import webapp2
+from datetime import datetime, timedelta
 
-from google.appengine.api import mail, app_identity
-from models import User
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from models import (Game, Leaderboard, ReminderCheckpoint, GlobalStats,
+                    ScoreDeltaMarker, StatShard)
+from utils import get_user_names
+import settings
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        """Start a reminder run for every User with an active game and
+        delete the checkpoints of old runs. Called every hour using a cron
+        job"""
+        now = datetime.utcnow()
+        run = now.strftime('%Y%m%d%H')
+        _add_tasks([_scan_task(run, 0, None)])
+        swept = ReminderCheckpoint.sweep(now - timedelta(
+            hours=settings.REMINDER_CHECKPOINT_HOURS))
+        logging.info('Deleted %d reminder checkpoints', swept)
+
+
+class ScanReminderUsers(webapp2.RequestHandler):
+    def post(self):
+        """Find one batch of Users that have an active game, hand them to a
+        send task and queue the scan of the next batch"""
+        run = self.request.get('run')
+        page = int(self.request.get('page'))
+        cursor = Cursor(urlsafe=self.request.get('cursor'))
+        games, next_cursor, more = Game.query(
+            Game.game_over == False,
+            projection=[Game.user],
+            distinct=True).fetch_page(settings.REMINDER_BATCH_SIZE,
+                                      start_cursor=cursor)
+
+        tasks = []
+        if games:
+            tasks.append(taskqueue.Task(
+                url='/tasks/reminders/send',
+                name='reminders-{}-send-{}'.format(run, page),
+                params={'users': ','.join(game.user.urlsafe()
+                                          for game in games)}))
+        if more:
+            tasks.append(_scan_task(run, page + 1, next_cursor))
+        _add_tasks(tasks)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send the reminder emails for one batch of Users. Progress is
+        checkpointed so a retried task resumes after the last User that
+        was checkpointed instead of starting over"""
+        checkpoint = ReminderCheckpoint.get_or_insert(
+            self.request.headers.get('X-AppEngine-TaskName', 'untitled'))
+        if checkpoint.done:
+            return
+
+        user_keys = [ndb.Key(urlsafe=urlsafe)
+                     for urlsafe in self.request.get('users').split(',')]
+        users = ndb.get_multi(user_keys[checkpoint.sent:])
+        sender = 'noreply@{}.appspotmail.com'.format(
+            app_identity.get_application_id())
         for user in users:
-            subject = 'This is a reminder!'
-            body = 'Hello {}, try out Guess A Number!'.format(user.name)
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
-
-
-app = webapp2.WSGIApplication([
-    ('/crons/send_reminder', SendReminderEmail)
-], debug=True)
+            if user and user.email:
+                # This will send test emails, the arguments to send_mail are:
+                # from, to, subject, body
+                mail.send_mail(sender,
+                               user.email,
+                               'This is a reminder!',
+                               'Hello {}, your Battleship game is waiting '
+                               'for your next move!'.format(user.name))
+            checkpoint.sent += 1
+            if checkpoint.sent % settings.REMINDER_CHECKPOINT_EVERY == 0:
+                checkpoint.put()
+
+        checkpoint.done = True
+        checkpoint.put()
+
+
+def _scan_task(run, page, cursor):
+    return taskqueue.Task(url='/tasks/reminders/scan',
+                          name='reminders-{}-scan-{}'.format(run, page),
+                          params={'run': run,
+                                  'page': page,
+                                  'cursor': cursor.urlsafe() if cursor
+                                  else ''})
+
+
+def _add_tasks(tasks):
+    """Queues the tasks of a reminder run. Task names are derived from the
+    run and page, so a retried handler can't queue the same batch twice"""
+    if not tasks:
+        return
+    try:
+        taskqueue.Queue('reminders').add(tasks)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Reminder tasks already queued: %s',
+                     ', '.join(task.name for task in tasks))
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+    def get(self):
+        """Regenerate the Leaderboard snapshot from the Score table.
+        Called periodically using a cron job"""
+        board = Leaderboard.rebuild()
+        logging.info('Leaderboard rebuilt with %d entries',
+                     len(board.by_victories))
+
+
+class CacheAverageAttempts(webapp2.RequestHandler):
+    def get(self):
+        """Drain the StatShards changed since the last rollup into Score and
+        GlobalStats, then fold the updated Scores into the Leaderboard.
+        Called every few minutes using a cron job"""
+        until = datetime.utcnow()
+        rolled_up_to = GlobalStats.get_stats().rolled_up_to
+        if rolled_up_to:
+            since = rolled_up_to - timedelta(
+                seconds=settings.STATS_ROLLUP_MARGIN)
+        else:
+            since = datetime(1970, 1, 1)
+        scores = StatShard.rollup(since, until)
+        if scores:
+            Leaderboard.record(scores,
+                               get_user_names(score.user for score in scores))
+        GlobalStats.mark_rolled_up(until)
+        logging.info('Rolled up stats of %d users', len(scores))
+
+
+class ApplyScoreDeltas(webapp2.RequestHandler):
+    def get(self):
+        """Fold the score deltas queued with SCORE_WRITE_BEHIND into Score,
+        GlobalStats and the Leaderboard. Polls the queue until
+        SCORE_WORKER_SECONDS are used up. Called every minute using a cron
+        job"""
+        if not settings.SCORE_WRITE_BEHIND:
+            return
+        queue = taskqueue.Queue(settings.SCORE_DELTA_QUEUE)
+        deadline = time.time() + settings.SCORE_WORKER_SECONDS
+        applied = 0
+        # The time left is checked before every lease, busy or idle, so a
+        # worker never runs into the next one started by the cron
+        while time.time() < deadline:
+            tasks = queue.lease_tasks(settings.SCORE_DELTA_LEASE,
+                                      settings.SCORE_DELTA_BATCH)
+            if tasks:
+                scores = StatShard.apply_deltas(tasks)
+                if scores:
+                    Leaderboard.record(
+                        scores,
+                        get_user_names(score.user for score in scores))
+                # Only deleted once applied, a failed batch is leased again
+                queue.delete_tasks(tasks)
+                applied += len(tasks)
+            if len(tasks) < settings.SCORE_DELTA_BATCH:
+                if time.time() + settings.SCORE_MAX_STALENESS > deadline:
+                    break
+                time.sleep(settings.SCORE_MAX_STALENESS)
+        swept = ScoreDeltaMarker.sweep(datetime.utcnow() - timedelta(
+            days=settings.SCORE_MARKER_DAYS))
+        logging.info('Applied %d score delta tasks, swept %d markers',
+                     applied, swept)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the endpoints API, models and forms before a new instance
+        gets its first request. Called by App Engine when it starts an
+        instance"""
+        start = time.time()
+        import api
+        logging.info('Warmed up %s in %.2fs', api.__name__,
+                     time.time() - start)
+
+
+# Rarely used handlers are named by string, so webapp2 only imports their
+# module when one of their routes is first requested. toplevel waits for the
+# cache deletes left pending by each request
+app = ndb.toplevel(webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
+    ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/reminders/scan', ScanReminderUsers),
+    ('/tasks/reminders/send', SendReminderBatch),
+    ('/crons/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/cache_average_attempts', CacheAverageAttempts),
+    ('/crons/apply_score_deltas', ApplyScoreDeltas),
+    ('/crons/reap_games', 'maintenance.ReapGames'),
+    ('/tasks/reap_games', 'maintenance.ReapGames'),
+    ('/crons/reconcile_active_games', 'maintenance.ReconcileActiveGames'),
+    ('/tasks/reconcile_active_games', 'maintenance.ReconcileActiveGames'),
+    ('/admin/export', 'maintenance.StartExport'),
+    (r'/admin/export/(\d+)\.ndjson', 'maintenance.DownloadExport'),
+    ('/tasks/export/chunk', 'maintenance.WriteExportChunk'),
+    ('/tasks/backfill_last_activity', 'maintenance.BackfillLastActivity'),
+    ('/tasks/migrate_scores', 'maintenance.MigrateScores'),
+    ('/tasks/migrate_users', 'maintenance.MigrateUsers')
+], debug=True))
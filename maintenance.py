@@ -0,0 +1,167 @@
+"""maintenance.py - Handlers for rarely run admin jobs: reaping abandoned
+games, repairing the active games indexes, exporting games and re-keying
+legacy entities. main.py routes to
+them by name, so this module is only imported when one of them runs."""
+import logging
+import time
+import webapp2
+from datetime import datetime, timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from models import (User, Game, Score, Leaderboard, ActiveGames, ExportJob,
+                    ExportChunk)
+import settings
+
+_TIME = '%Y-%m-%dT%H:%M:%S'
+
+
+class ReapGames(webapp2.RequestHandler):
+    def get(self):
+        """Start deleting games in progress that nobody played for
+        ABANDONED_GAME_DAYS. Called daily using a cron job"""
+        cutoff = datetime.utcnow() - timedelta(
+            days=settings.ABANDONED_GAME_DAYS)
+        self._reap(cutoff.replace(microsecond=0), None, 0, 0.0)
+
+    def post(self):
+        """Continue a reaper run from the cursor where the last request
+        stopped"""
+        self._reap(datetime.strptime(self.request.get('cutoff'), _TIME),
+                   Cursor(urlsafe=self.request.get('cursor')),
+                   int(self.request.get('deleted')),
+                   float(self.request.get('seconds')))
+
+    def _reap(self, cutoff, cursor, deleted, seconds):
+        """Deletes batches until REAPER_TIME_BUDGET is used up, then queues
+        a task for the rest. The totals of the run so far are logged"""
+        start = time.time()
+        more = True
+        while more and time.time() - start < settings.REAPER_TIME_BUDGET:
+            count, cursor, more = Game.reap(cutoff, cursor)
+            deleted += count
+        seconds += time.time() - start
+        logging.info('Reaped %d games in %.2fs, %.1f games/s', deleted,
+                     seconds, deleted / seconds if seconds else 0.0)
+        if more:
+            taskqueue.add(url='/tasks/reap_games',
+                          params={'cutoff': cutoff.strftime(_TIME),
+                                  'cursor': cursor.urlsafe(),
+                                  'deleted': deleted,
+                                  'seconds': seconds})
+
+
+class ReconcileActiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start repairing every User's ActiveGames index from the Game
+        table. Called daily using a cron job"""
+        self._reconcile(None)
+
+    def post(self):
+        """Repair the next batch of Users after the cursor"""
+        self._reconcile(Cursor(urlsafe=self.request.get('cursor')))
+
+    def _reconcile(self, cursor):
+        keys, next_cursor, more = User.query().fetch_page(
+            100, start_cursor=cursor, keys_only=True)
+        ndb.Future.wait_all([ActiveGames.reconcile_async(key)
+                             for key in keys])
+        logging.info('Reconciled the active games of %d users', len(keys))
+        if more:
+            taskqueue.add(url='/tasks/reconcile_active_games',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class StartExport(webapp2.RequestHandler):
+    def get(self):
+        """Start an NDJSON export of every Game and its moves, or resume
+        the export given as job from its last chunk. Responds with the job
+        id"""
+        job_id = self.request.get('job')
+        job = ExportJob.start(int(job_id) if job_id else None)
+        if not job:
+            self.abort(404)
+        self.response.content_type = 'text/plain'
+        self.response.write(job.key.id())
+
+
+class WriteExportChunk(webapp2.RequestHandler):
+    def post(self):
+        """Write one chunk of an export and queue the next one"""
+        ExportJob.write_chunk(
+            ndb.Key(ExportJob, int(self.request.get('job'))),
+            int(self.request.get('chunk')))
+
+
+class DownloadExport(webapp2.RequestHandler):
+    def get(self, job_id):
+        """Send one chunk of a finished export, given as chunk and counted
+        from 0, as newline-delimited JSON. The X-Export-Chunks header holds
+        the number of chunks, so a client fetches them one per request and
+        no response comes near the response size limit"""
+        job = ExportJob.get_by_id(int(job_id))
+        if not job or not job.done:
+            self.abort(404)
+        try:
+            chunk = int(self.request.get('chunk') or 0)
+        except ValueError:
+            self.abort(400)
+        if not 0 <= chunk < job.chunks:
+            self.abort(404)
+        data = ExportChunk.key_for(job.key, chunk).get(use_cache=False,
+                                                        use_memcache=False)
+        self.response.content_type = 'application/x-ndjson'
+        self.response.headers['X-Export-Chunks'] = str(job.chunks)
+        self.response.write(data.data)
+
+
+class BackfillLastActivity(webapp2.RequestHandler):
+    def post(self):
+        """Save one batch of games in progress that have no last_activity,
+        so the reaper can find them, then queue the next batch. Run once
+        after deploying last_activity"""
+        cursor = Cursor(urlsafe=self.request.get('cursor'))
+        saved, next_cursor, more = Game.backfill_last_activity(cursor)
+        logging.info('Backfilled last_activity of %d games', saved)
+        if more:
+            taskqueue.add(url='/tasks/backfill_last_activity',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class MigrateScores(webapp2.RequestHandler):
+    def post(self):
+        """Re-key one batch of Scores created with automatic ids so they
+        are keyed by their User, then queue the next batch"""
+        cursor = Cursor(urlsafe=self.request.get('cursor'))
+        keys, next_cursor, more = Score.query().fetch_page(
+            100, start_cursor=cursor, keys_only=True)
+        scores = ndb.get_multi(keys)
+        legacy = [score for score in scores
+                  if score and score.key != Score.key_for_user(score.user)]
+        for score in legacy:
+            Score.merge(score.key, score.user)
+        logging.info('Migrated %d of %d scores', len(legacy), len(keys))
+        if more:
+            taskqueue.add(url='/tasks/migrate_scores',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    def post(self):
+        """Re-key one batch of Users created with automatic ids by their
+        name, then queue the next batch. The leaderboard is rebuilt after
+        the last batch so it refers to the new keys"""
+        cursor = Cursor(urlsafe=self.request.get('cursor'))
+        keys, next_cursor, more = User.query().fetch_page(
+            100, start_cursor=cursor, keys_only=True)
+        legacy = [key for key in keys
+                  if not isinstance(key.id(), basestring)]
+        for key in legacy:
+            User.migrate(key)
+        logging.info('Migrated %d of %d users', len(legacy), len(keys))
+        if more:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            Leaderboard.rebuild()
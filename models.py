@@ -1,245 +1,1204 @@
 """models.py - This file contains the class definitions for the Datastore
 entities used by the Game. Because these classes are also regular Python
-classes they can include methods (such as 'to_form' and 'new_game')."""
+classes they can include methods (such as 'to_form' and 'build')."""
 
-from random import randint
-from datetime import date
+import itertools
+import json
+import logging
+import re
+import sys
+import time
+from array import array
+from collections import defaultdict
+from datetime import date, datetime
+from random import randrange
+from google.appengine.api import datastore_errors, memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
+from protorpc import protobuf
+from board import Board
+import cache
+import engine
+import settings
+from utils import get_user_name, get_user_names
 from forms import (
     GameForm,
     UserActiveGamesForm,
     HistoryGameForm,
     UserRankingForm,
-    HighScoreForm)
+    HighScoreForm,
+    StatsForm)
 
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Users are keyed by their unique name, so looking one
+    up is a strongly consistent key read. Users created before that have
+    automatic ids until the /tasks/migrate_users task re-keys them"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
 
+    LEGACY_NAMESPACE = 'legacy-user-keys'
+    # The datastore rejects key names like __name__ and longer than 1500
+    # bytes
+    RESERVED_NAME = re.compile(r'^__.*__$')
+    MAX_NAME_BYTES = 1500
+
+    @classmethod
+    def valid_name(cls, name):
+        """Returns whether the name can be used as a User's key name"""
+        return bool(name and not cls.RESERVED_NAME.match(name) and
+                    len(name.encode('utf-8')) <= cls.MAX_NAME_BYTES)
+
+    @classmethod
+    def key_for_name(cls, name):
+        return ndb.Key(cls, name)
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Returns the User with that name or None"""
+        if not cls.valid_name(name):
+            raise ndb.Return(None)
+        user = yield cls.key_for_name(name).get_async()
+        if user or not settings.LEGACY_USER_LOOKUP:
+            raise ndb.Return(user)
+        user = yield cls._get_legacy_async(name)
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.tasklet
+    def _get_legacy_async(cls, name):
+        """Finds a User that still has an automatic id. The name to key
+        mapping is kept in memcache so the query runs once per name"""
+        ctx = ndb.get_context()
+        urlsafe = yield ctx.memcache_get(name,
+                                         namespace=cls.LEGACY_NAMESPACE)
+        if urlsafe:
+            user = yield ndb.Key(urlsafe=urlsafe).get_async()
+            if user:
+                raise ndb.Return(user)
+        user = yield cls.query(cls.name == name).get_async()
+        if user:
+            yield ctx.memcache_set(name, user.key.urlsafe(),
+                                   namespace=cls.LEGACY_NAMESPACE)
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.tasklet
+    def create_async(cls, name, email):
+        """Creates and returns a User, or None if the name is taken. Raises
+        ValueError for a name that can't be a key name"""
+        if not cls.valid_name(name):
+            raise ValueError('Invalid Username')
+        if settings.LEGACY_USER_LOOKUP:
+            legacy = yield cls._get_legacy_async(name)
+            if legacy:
+                raise ndb.Return(None)
+        user = yield cls._create_async(name, email)
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _create_async(cls, name, email):
+        key = cls.key_for_name(name)
+        existing = yield key.get_async()
+        if existing:
+            raise ndb.Return(None)
+        user = cls(key=key, name=name, email=email)
+        yield user.put_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    def migrate(cls, legacy_key):
+        """Re-keys a User created with an automatic id by its name. Games
+        are pointed at the new key, and the Score and the counter shards
+        are merged into the ones keyed by the new User. Safe to run again
+        after a failure"""
+        legacy = legacy_key.get()
+        if not legacy:
+            return
+        user = cls.get_or_insert(legacy.name, name=legacy.name,
+                                 email=legacy.email)
+        # Before the Score is merged, so score deltas still queued under
+        # the legacy key are applied to the new Score from here on
+        MigratedUser(key=MigratedUser.key_for(legacy_key),
+                     user=user.key).put()
+        Game.reassign(legacy_key, user.key)
+        for score_key in Score.query(Score.user == legacy_key).fetch(
+                keys_only=True):
+            Score.merge(score_key, user.key)
+        legacy_key.delete()
+        memcache.delete(legacy.name, namespace=cls.LEGACY_NAMESPACE)
+        # Games created while the legacy User was being migrated
+        Game.reassign(legacy_key, user.key)
+        # Counters of the legacy User's games not rolled up yet, which the
+        # rollup would otherwise drain into a Score nobody reads
+        StatShard.drain_user(legacy_key, user.key)
+
+
+class MigratedUser(ndb.Model):
+    """The new key of a User re-keyed by User.migrate, keyed by the
+    automatic id it had before"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+    @classmethod
+    def key_for(cls, legacy_key):
+        return ndb.Key(cls, legacy_key.id())
+
+    @classmethod
+    def resolve(cls, user_keys):
+        """Returns a dict mapping the keys of migrated Users to their new
+        keys. Users keyed by name are never looked up"""
+        legacy = [key for key in user_keys
+                  if not isinstance(key.id(), basestring)]
+        moved = ndb.get_multi([cls.key_for(key) for key in legacy])
+        return dict((key, entity.user)
+                    for key, entity in zip(legacy, moved) if entity)
+
+
+def _unpack(blob, typecode):
+    """Reads a little endian packed array"""
+    values = array(typecode)
+    if blob:
+        values.fromstring(blob)
+        if sys.byteorder == 'big':
+            values.byteswap()
+    return values
+
+
+def _pack(values):
+    """Packs an array little endian"""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+# Optional board fields of the Game forms, by name. Compact responses send
+# the shots as a packed bit array instead of the guesses and rendered board
+FULL_FIELDS = frozenset(['guesses', 'rows', 'board'])
+COMPACT_FIELDS = frozenset(['shots'])
+FORM_FIELDS = FULL_FIELDS | COMPACT_FIELDS
+
+# The form fields set for each optional board field
+FORM_FIELD_NAMES = {
+    'guesses': ('guesses',),
+    'rows': ('rowA', 'rowB', 'rowC', 'rowD', 'rowE'),
+    'board': ('board',),
+    'shots': ('shots', 'hits'),
+}
+
 
 class Game(ndb.Model):
-    """Game object"""
+    """Game object. Shots are stored as a packed bit array and ships as
+    lists of their cells, see board.Board. The order of the guesses is kept
+    in moves, a packed array of 16 bit cell numbers, and move_times holds
+    the 32 bit Unix time of each move. Moves made before times were kept
+    have none, so move_times covers the latest moves only. Games created
+    before the move log only have the repeated guesses and ship_location
+    properties, they are converted when loaded and dropped on the next
+    put"""
     user = ndb.KeyProperty(required=True, kind='User')
-    guesses = ndb.IntegerProperty(repeated=True)
-    ship_location = ndb.IntegerProperty(required=True)
+    moves = ndb.BlobProperty()
+    move_times = ndb.BlobProperty()
+    legacy_guesses = ndb.IntegerProperty('guesses', repeated=True,
+                                         indexed=False)
+    ship_location = ndb.IntegerProperty(indexed=False)
+    width = ndb.IntegerProperty(default=5, indexed=False)
+    height = ndb.IntegerProperty(default=5, indexed=False)
+    ships = ndb.JsonProperty()
+    shots = ndb.BlobProperty()
     attempts_allowed = ndb.IntegerProperty(required=True, default=5)
     attempts_remaining = ndb.IntegerProperty(required=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
+    last_activity = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    @ndb.tasklet
+    def save_new_async(cls, user, games):
+        """Puts new games of a User and counts them as started. Each game
+        is its own entity group, so they are written in batches that fit a
+        cross-group transaction next to a StatShard of the User, and the
+        batches commit concurrently. A batch that fails doesn't stop the
+        rest. The saved games are added to the User's ActiveGames once every
+        batch has committed. Returns the error of each game's batch, None
+        for the games that were saved"""
+        size = settings.MAX_TRANSACTION_GROUPS - 1
+        batches = [games[start:start + size]
+                   for start in range(0, len(games), size)]
+        batch_errors = yield [cls._try_save_new_async(user, batch)
+                              for batch in batches]
+        errors = []
+        for batch, error in zip(batches, batch_errors):
+            errors.extend([error] * len(batch))
+        saved = [game.key for game, error in zip(games, errors)
+                 if not error]
+        if saved:
+            yield ActiveGames.update_async(user, added=saved)
+        raise ndb.Return(errors)
+
+    @classmethod
+    @ndb.tasklet
+    def _try_save_new_async(cls, user, games):
+        try:
+            yield cls._save_new_async(user, games)
+        except datastore_errors.Error, e:
+            logging.warning('Could not save %d new games: %s',
+                            len(games), e)
+            raise ndb.Return(e)
+        raise ndb.Return(None)
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _save_new_async(cls, user, games):
+        shards = yield StatShard.tally_async(
+            {user: {'games_started': len(games)}})
+        yield ndb.put_multi_async(games + shards)
 
     @classmethod
-    def new_game(cls, user, attempts):
-        """Creates and returns a new game"""
-        ship_location = randint(1, 25)
+    def build(cls, user, attempts, width=5, height=5, ship_lengths=(1,)):
+        """Returns a new, unsaved game with its ships placed. Raises
+        ValueError when the ships don't fit on the board"""
+        board = engine.place_ships(width, height, ship_lengths)
 
         game = Game(user=user,
-                    ship_location=ship_location,
+                    width=width,
+                    height=height,
                     attempts_allowed=attempts,
                     attempts_remaining=attempts,
                     game_over=False)
-        game.put()
+        game._board = board
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
-        row1 = (['O'] * 5)
-        row2 = (['O'] * 5)
-        row3 = (['O'] * 5)
-        row4 = (['O'] * 5)
-        row5 = (['O'] * 5)
-
-        if len(self.guesses) > 0:
-            for guesses in self.guesses:
-                col = guesses % 5
-                if guesses >= 1 and guesses <= 5:
-                    row1[col-1] = 'X'
-                if guesses >= 6 and guesses <= 10:
-                    row2[col-1] = 'X'
-                if guesses >= 11 and guesses <= 15:
-                    row3[col-1] = 'X'
-                if guesses >= 16 and guesses <= 20:
-                    row4[col-1] = 'X'
-                if guesses >= 21 and guesses <= 25:
-                    row5[col-1] = 'X'
-
-        if self.game_over is True:
-            for guesses in self.guesses:
-                if guesses == self.ship_location:
-                    col = guesses % 5
-                    if guesses >= 1 and guesses <= 5:
-                        row1[col-1] = 'S'
-                    if guesses >= 6 and guesses <= 10:
-                        row2[col-1] = 'S'
-                    if guesses >= 11 and guesses <= 15:
-                        row3[col-1] = 'S'
-                    if guesses >= 16 and guesses <= 20:
-                        row4[col-1] = 'S'
-                    if guesses >= 21 and guesses <= 25:
-                        row5[col-1] = 'S'
-
-        row1 = ' '.join(row1)
-        row2 = ' '.join(row2)
-        row3 = ' '.join(row3)
-        row4 = ' '.join(row4)
-        row5 = ' '.join(row5)
+    @classmethod
+    def reap(cls, cutoff, cursor=None):
+        """Deletes one batch of games in progress that haven't been played
+        since cutoff, found with a keys-only query. With REAPER_ARCHIVE the
+        games are read first, to skip any played since the index was
+        updated and to count them as abandoned in their owners' stats.
+        Returns the number of games deleted, the cursor of the next batch
+        and whether more may follow"""
+        keys, next_cursor, more = cls.query(
+            cls.game_over == False,
+            cls.last_activity < cutoff).fetch_page(
+                settings.REAPER_BATCH_SIZE, start_cursor=cursor,
+                keys_only=True)
+        if settings.REAPER_ARCHIVE:
+            games = [game for game in ndb.get_multi(keys)
+                     if game and not game.game_over and
+                     game.last_activity < cutoff]
+            keys = [game.key for game in games]
+        ndb.delete_multi(keys)
+        if settings.REAPER_ARCHIVE:
+            cls._record_reaped(games)
+        return len(keys), next_cursor, more
+
+    @classmethod
+    def backfill_last_activity(cls, cursor=None):
+        """Saves one batch of games in progress that were last put before
+        last_activity existed, so the reaper can find them. Returns the
+        number of games saved, the cursor of the next batch and whether
+        more may follow"""
+        keys, next_cursor, more = cls.query(
+            cls.game_over == False).fetch_page(
+                settings.REAPER_BATCH_SIZE, start_cursor=cursor,
+                keys_only=True)
+        futures = [cls._backfill_last_activity_async(key) for key in keys]
+        saved = sum(1 for future in futures if future.get_result())
+        return saved, next_cursor, more
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _backfill_last_activity_async(cls, key):
+        game = yield key.get_async()
+        if not game or game.game_over or game.last_activity:
+            raise ndb.Return(False)
+        yield game.put_async()
+        raise ndb.Return(True)
+
+    @classmethod
+    def _record_reaped(cls, games):
+        """Counts deleted games as abandoned in their owners' stats, then
+        drops them from their ActiveGames. Owners are split into batches
+        that each fit one cross-group transaction, and the batches commit
+        concurrently"""
+        by_user = defaultdict(list)
+        for game in games:
+            by_user[game.user].append(game.key)
+        users = by_user.keys()
+        size = settings.MAX_TRANSACTION_GROUPS
+        futures = [cls._record_reaped_async(
+                       dict((user, by_user[user])
+                            for user in users[start:start + size]))
+                   for start in range(0, len(users), size)]
+        for future in futures:
+            future.get_result()
+        futures = [ActiveGames.update_async(user, removed=by_user[user])
+                   for user in users]
+        for future in futures:
+            future.get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _record_reaped_async(cls, by_user):
+        shards = yield StatShard.tally_async(dict(
+            (user, {'games_abandoned': len(keys)})
+            for user, keys in by_user.items()))
+        yield ndb.put_multi_async(shards)
+
+    @classmethod
+    def reassign(cls, from_user_key, to_user_key):
+        """Points every Game of one User key at another"""
+        keys = cls.query(cls.user == from_user_key).fetch(keys_only=True)
+        games = ndb.get_multi(keys)
+        for game in games:
+            game.user = to_user_key
+        ndb.put_multi(games)
 
+    @property
+    def move_log(self):
+        """The guesses in the order they were made, as an array"""
+        move_log = getattr(self, '_move_log', None)
+        if move_log is None:
+            if self.moves is not None:
+                move_log = _unpack(self.moves, 'H')
+            else:
+                move_log = array('H', self.legacy_guesses)
+            self._move_log = move_log
+        return move_log
+
+    @property
+    def move_time_log(self):
+        """When each of the latest moves was made, as an array of Unix
+        times"""
+        move_times = getattr(self, '_move_times', None)
+        if move_times is None:
+            move_times = self._move_times = _unpack(self.move_times, 'I')
+        return move_times
+
+    @property
+    def guesses(self):
+        """The guesses in the order they were made"""
+        return self.move_log.tolist()
+
+    def fire(self, cell):
+        """Shoots at a cell and logs the move. Returns the index of the
+        ship that was hit, or None for a miss"""
+        self.move_log.append(cell)
+        self.move_time_log.append(int(time.time()))
+        return self.board.fire(cell)
+
+    @property
+    def board(self):
+        """The Board holding this game's shots and ships"""
+        board = getattr(self, '_board', None)
+        if board is None:
+            if self.ships is not None:
+                board = Board(self.width, self.height, self.ships,
+                              self.shots)
+            else:
+                board = Board.from_legacy(self.width, self.height,
+                                          self.ship_location, self.move_log)
+            self._board = board
+        return board
+
+    def _pre_put_hook(self):
+        board = getattr(self, '_board', None)
+        if board is not None:
+            self.ships = board.ships
+            self.shots = str(board.shots)
+        move_log = getattr(self, '_move_log', None)
+        if move_log is not None:
+            self.moves = _pack(move_log)
+            self.legacy_guesses = []
+        move_times = getattr(self, '_move_times', None)
+        if move_times is not None:
+            self.move_times = _pack(move_times)
+
+    def _post_put_hook(self, future):
+        cache.invalidate(self.key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        cache.invalidate(key)
+
+    def is_won(self):
+        return self.board.all_sunk()
+
+    def _board_state(self):
+        # Guesses are only ever appended, so this identifies the board
+        return len(self.move_log), self.game_over
+
+    def cache_board(self, board):
+        """Attaches an already rendered board for render_board to reuse"""
+        self._rendered_board = self._board_state(), board
+
+    def render_board(self):
+        """Returns the board as one character per cell. Ships are only
+        revealed once the game is over"""
+        rendered = getattr(self, '_rendered_board', None)
+        if rendered and rendered[0] == self._board_state():
+            return rendered[1]
+        return self.board.render(reveal=self.game_over)
+
+    def export_record(self, user_name):
+        """Returns the Game and its moves for the NDJSON export. Moves are
+        [cell, Unix time] pairs, the time is None for moves made before
+        times were kept"""
+        moves = self.move_log
+        times = self.move_time_log
+        untimed = len(moves) - len(times)
+        return {
+            'game': self.key.urlsafe(),
+            'user': user_name,
+            'width': self.width,
+            'height': self.height,
+            'ships': self.board.ships,
+            'attempts_allowed': self.attempts_allowed,
+            'attempts_remaining': self.attempts_remaining,
+            'game_over': self.game_over,
+            'won': self.game_over and self.is_won(),
+            'last_activity': (self.last_activity.isoformat()
+                              if self.last_activity else None),
+            'moves': [[cell, times[index - untimed]
+                       if index >= untimed else None]
+                      for index, cell in enumerate(moves)],
+        }
+
+    @staticmethod
+    def form_fields(compact=False, fields=None):
+        """Returns the optional board fields a form should carry. fields
+        names them, otherwise compact picks the packed shots instead of the
+        guesses and rendered board. Raises ValueError for unknown names"""
+        if fields:
+            unknown = set(fields) - FORM_FIELDS
+            if unknown:
+                raise ValueError('Unknown fields: {}'.format(
+                    ', '.join(sorted(unknown))))
+            return frozenset(fields)
+        return COMPACT_FIELDS if compact else FULL_FIELDS
+
+    def _fill_board(self, form, fields):
+        """Sets the board fields shared by every Game form. The rowA-rowE
+        strings are only set for the classic 5x5 board, and the board is
+        only rendered when the board or rows are asked for"""
+        form.width = self.width
+        form.height = self.height
+        if 'guesses' in fields:
+            form.guesses = self.guesses
+        if 'shots' in fields:
+            form.shots = str(self.board.shots)
+            if self.game_over:
+                form.hits = str(self.board.hit_mask())
+        if 'board' in fields or 'rows' in fields:
+            board = self.render_board()
+            if 'board' in fields:
+                form.board = board
+            if 'rows' in fields and self.width == 5 and self.height == 5:
+                form.rowA, form.rowB, form.rowC, form.rowD, form.rowE = \
+                    self.board.rows(board)
+
+    def to_form(self, message, user_name=None, fields=FULL_FIELDS):
+        """Returns a GameForm representation of the Game. Pass user_name
+        when it is already known to skip fetching the User"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
-        form.guesses = self.guesses
-        form.rowA = row1
-        form.rowB = row2
-        form.rowC = row3
-        form.rowD = row4
-        form.rowE = row5
+        form.user_name = user_name or get_user_name(self.user)
+        self._fill_board(form, fields)
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.message = message
         return form
 
-    def active_form(self, message):
+    def active_form(self, message, user_name=None, fields=FULL_FIELDS):
         """Returns a GameForm representation of
-        the Game for users active games"""
-        row1 = (['O'] * 5)
-        row2 = (['O'] * 5)
-        row3 = (['O'] * 5)
-        row4 = (['O'] * 5)
-        row5 = (['O'] * 5)
-
-        if len(self.guesses) > 0:
-            for guesses in self.guesses:
-                col = guesses % 5
-                if guesses >= 1 and guesses <= 5:
-                    row1[col-1] = 'X'
-                if guesses >= 6 and guesses <= 10:
-                    row2[col-1] = 'X'
-                if guesses >= 11 and guesses <= 15:
-                    row3[col-1] = 'X'
-                if guesses >= 16 and guesses <= 20:
-                    row4[col-1] = 'X'
-                if guesses >= 21 and guesses <= 25:
-                    row5[col-1] = 'X'
-
-        if self.game_over is True:
-            for guesses in self.guesses:
-                if guesses == self.ship_location:
-                    col = guesses % 5
-                    if guesses >= 1 and guesses <= 5:
-                        row1[col-1] = 'S'
-                    if guesses >= 6 and guesses <= 10:
-                        row2[col-1] = 'S'
-                    if guesses >= 11 and guesses <= 15:
-                        row3[col-1] = 'S'
-                    if guesses >= 16 and guesses <= 20:
-                        row4[col-1] = 'S'
-                    if guesses >= 21 and guesses <= 25:
-                        row5[col-1] = 'S'
-
-        row1 = ' '.join(row1)
-        row2 = ' '.join(row2)
-        row3 = ' '.join(row3)
-        row4 = ' '.join(row4)
-        row5 = ' '.join(row5)
-
+        the Game for users active games. Pass user_name
+        when it is already known to skip fetching the User"""
         form = UserActiveGamesForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
-        form.guesses = self.guesses
-        form.rowA = row1
-        form.rowB = row2
-        form.rowC = row3
-        form.rowD = row4
-        form.rowE = row5
+        form.user_name = user_name or get_user_name(self.user)
+        self._fill_board(form, fields)
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.message = message
         return form
 
-    def history_form(self):
+    def history_form(self, fields=FULL_FIELDS):
         """Returns a GameForm representation of
         the Game for users history of games"""
-        row1 = (['O'] * 5)
-        row2 = (['O'] * 5)
-        row3 = (['O'] * 5)
-        row4 = (['O'] * 5)
-        row5 = (['O'] * 5)
-
-        if len(self.guesses) > 0:
-            for guesses in self.guesses:
-                col = guesses % 5
-                if guesses >= 1 and guesses <= 5:
-                    row1[col-1] = 'X'
-                if guesses >= 6 and guesses <= 10:
-                    row2[col-1] = 'X'
-                if guesses >= 11 and guesses <= 15:
-                    row3[col-1] = 'X'
-                if guesses >= 16 and guesses <= 20:
-                    row4[col-1] = 'X'
-                if guesses >= 21 and guesses <= 25:
-                    row5[col-1] = 'X'
-
-        if self.game_over is True:
-            message = 'You Lost'
-            for guesses in self.guesses:
-                if guesses == self.ship_location:
-                    message = 'You Won!'
-                    col = guesses % 5
-                    if guesses >= 1 and guesses <= 5:
-                        row1[col-1] = 'S'
-                    if guesses >= 6 and guesses <= 10:
-                        row2[col-1] = 'S'
-                    if guesses >= 11 and guesses <= 15:
-                        row3[col-1] = 'S'
-                    if guesses >= 16 and guesses <= 20:
-                        row4[col-1] = 'S'
-                    if guesses >= 21 and guesses <= 25:
-                        row5[col-1] = 'S'
-
         if self.game_over is False:
             message = 'Game Not Finished!'
-
-        row1 = ' '.join(row1)
-        row2 = ' '.join(row2)
-        row3 = ' '.join(row3)
-        row4 = ' '.join(row4)
-        row5 = ' '.join(row5)
+        elif self.is_won():
+            message = 'You Won!'
+        else:
+            message = 'You Lost'
 
         form = HistoryGameForm()
-        form.guesses = self.guesses
-        form.rowA = row1
-        form.rowB = row2
-        form.rowC = row3
-        form.rowD = row4
-        form.rowE = row5
+        self._fill_board(form, fields)
         form.attempts_remaining = self.attempts_remaining
         form.attempts_allowed = self.attempts_allowed
         form.message = message
         form.game_over = self.game_over
         return form
 
-    def user_score(self):
-        '''Creates Score Model for user'''
-        score = Score(user=self.user, date=date.today())
-        score.put()
 
+class GameSnapshot(ndb.Model):
+    """The final HistoryGameForm of a finished Game with every board field,
+    encoded once when the game ends. Its parent is the Game, so it is put
+    in the same transaction at no extra entity group cost"""
+    form = ndb.BlobProperty()
 
-class Score(ndb.Model):
-    """Score object"""
+    @classmethod
+    def key_for_game(cls, game_key):
+        return ndb.Key(cls, 1, parent=game_key)
+
+    @classmethod
+    def for_game(cls, game):
+        """Returns a new, unsaved snapshot of a finished Game"""
+        return cls(key=cls.key_for_game(game.key),
+                   form=protobuf.encode_message(
+                       game.history_form(FORM_FIELDS)))
+
+    def history_form(self, fields=FULL_FIELDS):
+        """Returns the stored HistoryGameForm with only the asked for board
+        fields set"""
+        form = protobuf.decode_message(HistoryGameForm, self.form)
+        for name in FORM_FIELDS - fields:
+            for field in FORM_FIELD_NAMES[name]:
+                form.reset(field)
+        return form
+
+
+class Aggregates(object):
+    """Counters shared by Score and GlobalStats, filled in from drained
+    StatShards"""
+
+    def add_counts(self, counts):
+        """Folds drained StatShard counter totals into the aggregates"""
+        self.victories += counts['victories']
+        self.losses += counts['losses']
+        self.win_attempts += counts['win_attempts']
+        self.timed_wins += counts['victories']
+        self.games_in_progress += (counts['games_started'] -
+                                   counts['games_finished'] -
+                                   counts['games_cancelled'] -
+                                   counts['games_abandoned'])
+        self.games_abandoned += counts['games_abandoned']
+        if self.victories + self.losses:
+            self.percentage = self.victories/(self.victories + self.losses)
+        if self.timed_wins:
+            self.average_attempts = (float(self.win_attempts) /
+                                     self.timed_wins)
+
+    def stats_form(self, user_name=None):
+        # Games started before counting began can make this negative
+        return StatsForm(user_name=user_name,
+                         victories=self.victories,
+                         losses=self.losses,
+                         percentage=self.percentage,
+                         average_attempts=self.average_attempts,
+                         games_in_progress=max(0, self.games_in_progress),
+                         games_abandoned=self.games_abandoned)
+
+
+class Score(Aggregates, ndb.Model):
+    """Score object. Kept up to date by the StatShard rollup, or by the
+    score delta worker with SCORE_WRITE_BEHIND. average_attempts only
+    covers wins since per-game counting began"""
     user = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateProperty(required=True)
     victories = ndb.FloatProperty(required=True, default=0.0)
     losses = ndb.FloatProperty(required=True, default=0.0)
     percentage = ndb.FloatProperty(required=True, default=0.0)
+    win_attempts = ndb.IntegerProperty(default=0, indexed=False)
+    timed_wins = ndb.IntegerProperty(default=0, indexed=False)
+    average_attempts = ndb.FloatProperty(default=0.0)
+    games_in_progress = ndb.IntegerProperty(default=0, indexed=False)
+    games_abandoned = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def key_for_user(cls, user_key):
+        """Scores are keyed by their User's id so they can be read
+        directly instead of queried"""
+        return ndb.Key(cls, user_key.id())
+
+    @classmethod
+    def for_user(cls, user_key):
+        """Returns a new, unsaved Score for the User"""
+        return cls(key=cls.key_for_user(user_key),
+                   user=user_key,
+                   date=date.today())
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def merge(cls, from_key, user_key):
+        """Folds the Score at from_key into the Score keyed by the User,
+        then deletes it"""
+        if from_key == cls.key_for_user(user_key):
+            return
+        old = from_key.get()
+        if not old:
+            return
+        score = cls.key_for_user(user_key).get() or cls.for_user(user_key)
+        score.date = min(score.date, old.date)
+        score.victories += old.victories
+        score.losses += old.losses
+        score.win_attempts += old.win_attempts
+        score.timed_wins += old.timed_wins
+        score.games_in_progress += old.games_in_progress
+        score.games_abandoned += old.games_abandoned
+        if score.victories + score.losses:
+            score.percentage = score.victories/(score.victories +
+                                                score.losses)
+        if score.timed_wins:
+            score.average_attempts = (float(score.win_attempts) /
+                                      score.timed_wins)
+        score.put()
+        from_key.delete()
+
+
+class LeaderboardEntry(ndb.Model):
+    """A player's standing inside the Leaderboard"""
+    user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(required=True)
+    victories = ndb.FloatProperty(required=True, default=0.0)
+    percentage = ndb.FloatProperty(required=True, default=0.0)
+
+    def high_score_form(self):
+        return HighScoreForm(user_name=self.user_name,
+                             total_wins=self.victories)
+
+    def user_ranking_form(self):
+        return UserRankingForm(user_name=self.user_name,
+                               percentage_wins=self.percentage)
+
+
+class Leaderboard(ndb.Model):
+    """Snapshot of the top Scores with user names inlined, so both
+    rankings are served from a single entity read"""
+    by_victories = ndb.LocalStructuredProperty(LeaderboardEntry,
+                                               repeated=True)
+    by_percentage = ndb.LocalStructuredProperty(LeaderboardEntry,
+                                                repeated=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    RANKINGS = ('victories', 'percentage')
+
+    @classmethod
+    def board_key(cls):
+        return ndb.Key(cls, 'global')
+
+    @classmethod
+    def get_board(cls):
+        """Returns the snapshot, building it from the Score table the
+        first time it is requested"""
+        return cls.get_board_async().get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_board_async(cls):
+        board = yield cls.board_key().get_async()
+        raise ndb.Return(board or cls.rebuild())
+
+    @classmethod
+    def rebuild(cls):
+        """Regenerates the snapshot from the Score table"""
+        futures = [Score.query().order(-getattr(Score, ranking))
+                   .fetch_async(settings.LEADERBOARD_DEPTH)
+                   for ranking in cls.RANKINGS]
+        rankings = [future.get_result() for future in futures]
+
+        names = get_user_names(score.user for scores in rankings
+                               for score in scores)
+
+        board = cls(key=cls.board_key())
+        for ranking, scores in zip(cls.RANKINGS, rankings):
+            setattr(board, 'by_' + ranking, [
+                LeaderboardEntry(user=score.user,
+                                 user_name=names[score.user],
+                                 victories=score.victories,
+                                 percentage=score.percentage)
+                for score in scores if score.user in names])
+        board.put()
+        return board
+
+    @classmethod
+    def record(cls, scores, names):
+        """Folds updated Scores into the snapshot with one transaction.
+        names maps User keys to names. Nothing is written when none of the
+        players is ranked or good enough to be ranked"""
+        board = cls.get_board()
+        scores = [score for score in scores if score.user in names and
+                  any(board._affected_by(score, ranking)
+                      for ranking in cls.RANKINGS)]
+        if scores:
+            cls._record(scores, names)
+
+    def _affected_by(self, score, ranking):
+        entries = getattr(self, 'by_' + ranking)
+        if len(entries) < settings.LEADERBOARD_DEPTH:
+            return True
+        if any(entry.user == score.user for entry in entries):
+            return True
+        return getattr(score, ranking) > getattr(entries[-1], ranking)
+
+    @classmethod
+    @ndb.transactional
+    def _record(cls, scores, names):
+        board = cls.board_key().get() or cls(key=cls.board_key())
+        updated = dict((score.user, LeaderboardEntry(
+                            user=score.user,
+                            user_name=names[score.user],
+                            victories=score.victories,
+                            percentage=score.percentage))
+                       for score in scores)
+        for ranking in cls.RANKINGS:
+            entries = [e for e in getattr(board, 'by_' + ranking)
+                       if e.user not in updated]
+            entries.extend(updated.values())
+            entries.sort(key=lambda e: getattr(e, ranking), reverse=True)
+            setattr(board, 'by_' + ranking,
+                    entries[:settings.LEADERBOARD_DEPTH])
+        board.put()
+
+
+class GlobalStats(Aggregates, ndb.Model):
+    """Totals over every player, kept up to date by the StatShard
+    rollup. rolled_up_to is the time the last rollup covered"""
+    victories = ndb.FloatProperty(default=0.0, indexed=False)
+    losses = ndb.FloatProperty(default=0.0, indexed=False)
+    percentage = ndb.FloatProperty(default=0.0, indexed=False)
+    win_attempts = ndb.IntegerProperty(default=0, indexed=False)
+    timed_wins = ndb.IntegerProperty(default=0, indexed=False)
+    average_attempts = ndb.FloatProperty(default=0.0, indexed=False)
+    games_in_progress = ndb.IntegerProperty(default=0, indexed=False)
+    games_abandoned = ndb.IntegerProperty(default=0, indexed=False)
+    rolled_up_to = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def stats_key(cls):
+        return ndb.Key(cls, 'global')
+
+    @classmethod
+    def get_stats(cls):
+        return cls.stats_key().get() or cls(key=cls.stats_key())
+
+    @classmethod
+    @ndb.transactional
+    def mark_rolled_up(cls, until):
+        stats = cls.get_stats()
+        stats.rolled_up_to = until
+        stats.put()
+
+
+def _add_transactional_task(queue_name, task):
+    """Adds a task in the ndb transaction of the running tasklet"""
+    from google.appengine.api import datastore, taskqueue
+    assert ndb.in_transaction()
+    # taskqueue reads the transaction from the datastore module's
+    # connection, which ndb points at the transaction started last. With
+    # several transactional tasklets running that may be another one's, so
+    # the connection is pointed at this tasklet's for the add. Nothing
+    # yields between setting it, the add and restoring it, so no other
+    # tasklet can run while the connection is swapped, and the previous one
+    # is restored even when the add fails
+    previous = datastore._GetConnection()
+    datastore._SetConnection(ndb.get_context()._conn)
+    try:
+        taskqueue.Queue(queue_name).add(task, transactional=True)
+    finally:
+        datastore._SetConnection(previous)
+
+
+class StatShard(ndb.Model):
+    """One shard of a User's game counters. Changes add to a random shard
+    inside the transaction of the change they count, so concurrent games
+    don't contend on one entity. The shards are drained into Score and
+    GlobalStats by the rollup run from /tasks/cache_average_attempts"""
+    user = ndb.KeyProperty(required=True, kind='User')
+    victories = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+    win_attempts = ndb.IntegerProperty(default=0, indexed=False)
+    games_started = ndb.IntegerProperty(default=0, indexed=False)
+    games_finished = ndb.IntegerProperty(default=0, indexed=False)
+    games_cancelled = ndb.IntegerProperty(default=0, indexed=False)
+    games_abandoned = ndb.IntegerProperty(default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    COUNTERS = ('victories', 'losses', 'win_attempts', 'games_started',
+                'games_finished', 'games_cancelled', 'games_abandoned')
+
+    @classmethod
+    def _shard_key(cls, user_key, shard=None):
+        if shard is None:
+            shard = randrange(settings.USER_STAT_SHARDS)
+        return ndb.Key(cls, '{}/{}'.format(user_key.urlsafe(), shard))
+
+    @classmethod
+    def drain_user(cls, user_key, into_key):
+        """Drains every shard of a User into the Score of the User keyed
+        into_key and into GlobalStats. Returns that Score"""
+        return cls._drain(into_key, [cls._shard_key(user_key, shard)
+                                     for shard in
+                                     range(settings.USER_STAT_SHARDS)])
+
+    @staticmethod
+    def game_ended(game):
+        """Counter changes for a game that just ended"""
+        if game.is_won():
+            return {'victories': 1,
+                    'games_finished': 1,
+                    'win_attempts': (game.attempts_allowed -
+                                     game.attempts_remaining)}
+        return {'losses': 1, 'games_finished': 1}
+
+    @classmethod
+    @ndb.tasklet
+    def tally_async(cls, changes):
+        """Adds counter changes, a dict of {User key: {counter: amount}},
+        to a random shard of each User with one get_multi. Returns the
+        shards, which the caller puts in the same transaction as the change
+        being counted. That touches one entity group per User. With
+        SCORE_WRITE_BEHIND the changes are queued as one task in the
+        current transaction instead, and no shards are returned"""
+        if settings.SCORE_WRITE_BEHIND:
+            cls._queue_deltas(changes)
+            raise ndb.Return([])
+        users = changes.keys()
+        keys = [cls._shard_key(user) for user in users]
+        loaded = yield ndb.get_multi_async(keys)
+        shards = []
+        for user, key, shard in zip(users, keys, loaded):
+            shard = shard or cls(key=key, user=user)
+            for name, amount in changes[user].items():
+                setattr(shard, name, getattr(shard, name) + amount)
+            shards.append(shard)
+        raise ndb.Return(shards)
+
+    @staticmethod
+    def _queue_deltas(changes):
+        # Only write-behind queues deltas, the default path doesn't need
+        # the module
+        from google.appengine.api import taskqueue
+        payload = json.dumps(dict((user.urlsafe(), counts)
+                                  for user, counts in changes.items()))
+        _add_transactional_task(settings.SCORE_DELTA_QUEUE,
+                                taskqueue.Task(payload=payload,
+                                               method='PULL'))
+
+    @classmethod
+    def apply_deltas(cls, tasks):
+        """Folds leased score delta tasks into Score and GlobalStats, one
+        cross-group transaction per batch of Users. Tasks that already have
+        a ScoreDeltaMarker under a Score are skipped. Returns the Scores
+        that changed"""
+        deltas = defaultdict(dict)
+        for task in tasks:
+            for urlsafe, counts in json.loads(task.payload).items():
+                deltas[ndb.Key(urlsafe=urlsafe)][task.name] = counts
+        # Deltas queued before their User was migrated
+        for legacy, user in MigratedUser.resolve(deltas.keys()).items():
+            for name, counts in deltas.pop(legacy).items():
+                merged = deltas[user].setdefault(name, {})
+                for counter, amount in counts.items():
+                    merged[counter] = merged.get(counter, 0) + amount
+        users = deltas.keys()
+        # Each User's Score and markers share a group, GlobalStats takes one
+        size = settings.MAX_TRANSACTION_GROUPS - 1
+        scores = []
+        for start in range(0, len(users), size):
+            scores.extend(cls._apply_deltas(
+                dict((user, deltas[user])
+                     for user in users[start:start + size])))
+        return scores
 
-    def high_scores(self):
-        return HighScoreForm(
-            user_name=self.user.get().name,
-            total_wins=self.victories
-        )
-
-    def user_rankings(self):
-        return UserRankingForm(
-            user_name=self.user.get().name,
-            percentage_wins=self.percentage
-        )
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _apply_deltas(cls, deltas):
+        users = deltas.keys()
+        score_keys = [Score.key_for_user(user) for user in users]
+        marker_keys = [[ScoreDeltaMarker.key_for_task(score_key, name)
+                        for name in deltas[user]]
+                       for user, score_key in zip(users, score_keys)]
+        entities = ndb.get_multi(
+            score_keys + [key for keys in marker_keys for key in keys] +
+            [GlobalStats.stats_key()])
+        stats = entities[-1] or GlobalStats(key=GlobalStats.stats_key())
+        found = set(entity.key for entity in entities[len(users):-1]
+                    if entity)
+
+        changed = []
+        markers = []
+        for index, user in enumerate(users):
+            new = [key for key in marker_keys[index] if key not in found]
+            if not new:
+                continue
+            score = entities[index] or Score.for_user(user)
+            totals = dict((name, 0) for name in cls.COUNTERS)
+            for key in new:
+                for counter, amount in deltas[user][key.id()].items():
+                    totals[counter] += amount
+            score.add_counts(totals)
+            stats.add_counts(totals)
+            changed.append(score)
+            markers.extend(ScoreDeltaMarker(key=key) for key in new)
+        if changed:
+            ndb.put_multi(changed + markers + [stats])
+        return changed
+
+    @classmethod
+    def rollup(cls, since, until):
+        """Drains the shards changed between since and until into their
+        Score and into GlobalStats. Returns the Scores that changed"""
+        scores = []
+        cursor, more = None, True
+        while more:
+            shards, cursor, more = cls.query(
+                cls.updated >= since, cls.updated < until).fetch_page(
+                    settings.STATS_ROLLUP_BATCH, start_cursor=cursor)
+            by_user = defaultdict(list)
+            for shard in shards:
+                if any(getattr(shard, name) for name in cls.COUNTERS):
+                    by_user[shard.user].append(shard.key)
+            for user, keys in by_user.items():
+                scores.append(cls._drain(user, keys))
+        return scores
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _drain(cls, user, shard_keys):
+        # Only the rollup and the score delta worker write GlobalStats
+        entities = ndb.get_multi(shard_keys + [Score.key_for_user(user),
+                                               GlobalStats.stats_key()])
+        shards = [shard for shard in entities[:-2] if shard]
+        score = entities[-2] or Score.for_user(user)
+        stats = entities[-1] or GlobalStats(key=GlobalStats.stats_key())
+
+        totals = dict((name, 0) for name in cls.COUNTERS)
+        for shard in shards:
+            for name in cls.COUNTERS:
+                totals[name] += getattr(shard, name)
+                setattr(shard, name, 0)
+        score.add_counts(totals)
+        stats.add_counts(totals)
+        ndb.put_multi(shards + [score, stats])
+        return score
+
+
+class ScoreDeltaMarker(ndb.Model):
+    """Marks a score delta task as folded into a Score. Keyed by the task
+    name under the Score, so it is written in the same transaction"""
+    applied = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for_task(cls, score_key, task_name):
+        return ndb.Key(cls, task_name, parent=score_key)
+
+    @classmethod
+    def sweep(cls, before):
+        """Deletes the markers written before the given time. Returns the
+        number deleted"""
+        deleted = 0
+        while True:
+            keys = cls.query(cls.applied < before).fetch(
+                settings.SCORE_DELTA_BATCH, keys_only=True)
+            ndb.delete_multi(keys)
+            deleted += len(keys)
+            if len(keys) < settings.SCORE_DELTA_BATCH:
+                return deleted
+
+
+class ActiveGames(ndb.Model):
+    """Keys of a User's games in progress, keyed by the User's id, so
+    get_user_games reads one entity instead of querying. Updated after the
+    transactions that create, finish, cancel and reap games commit, so
+    concurrent games of a User don't contend on it. complete is False while
+    games from before the index may be missing, until the index is
+    reconciled with the Game table"""
+    games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    complete = ndb.BooleanProperty(default=False, indexed=False)
+
+    @classmethod
+    def key_for_user(cls, user_key):
+        return ndb.Key(cls, user_key.id())
+
+    @classmethod
+    @ndb.tasklet
+    def load_async(cls, user_key):
+        """Returns the User's index, or a new incomplete one"""
+        key = cls.key_for_user(user_key)
+        active = yield key.get_async()
+        raise ndb.Return(active or cls(key=key))
+
+    @classmethod
+    @ndb.tasklet
+    def update_async(cls, user_key, added=(), removed=()):
+        """Adds and removes games in the User's index, in a transaction of
+        its own. Best effort: reads skip games that are over or gone, and
+        the daily reconcile adds back games a failed update missed"""
+        try:
+            yield cls._update_async(user_key, list(added), set(removed))
+        except datastore_errors.Error, e:
+            logging.warning('Could not update the active games of %s: %s',
+                            user_key.id(), e)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _update_async(cls, user_key, added, removed):
+        active = yield cls.load_async(user_key)
+        games = [key for key in active.games if key not in removed]
+        listed = set(games)
+        games.extend(key for key in added if key not in listed)
+        if games != active.games:
+            active.games = games
+            yield active.put_async()
+
+    @classmethod
+    @ndb.tasklet
+    def reconcile_async(cls, user_key):
+        """Repairs the User's index from the Game table. Games listed in
+        the index or found by the query are kept if a strongly consistent
+        read shows them still in progress. Returns the repaired index"""
+        key = cls.key_for_user(user_key)
+        found, active = yield (
+            Game.query(Game.user == user_key,
+                       Game.game_over == False).fetch_async(keys_only=True),
+            key.get_async())
+        candidates = set(found)
+        if active:
+            candidates.update(active.games)
+        games = yield ndb.get_multi_async(list(candidates))
+        keys = sorted(game.key for game in games
+                      if game and not game.game_over)
+        active = yield cls._save_reconciled_async(key, candidates, keys)
+        raise ndb.Return(active)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _save_reconciled_async(cls, key, candidates, keys):
+        active = (yield key.get_async()) or cls(key=key)
+        # Keep games created while the index was being repaired
+        active.games = keys + [game for game in active.games
+                               if game not in candidates]
+        active.complete = True
+        yield active.put_async()
+        raise ndb.Return(active)
+
+
+class ReminderCheckpoint(ndb.Model):
+    """Progress of one reminder send task, keyed by the task name"""
+    sent = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def sweep(cls, before):
+        """Deletes the checkpoints created before the given time. Returns
+        the number deleted"""
+        deleted = 0
+        while True:
+            keys = cls.query(cls.created < before).fetch(500, keys_only=True)
+            ndb.delete_multi(keys)
+            deleted += len(keys)
+            if len(keys) < 500:
+                return deleted
+
+
+class ExportJob(ndb.Model):
+    """An export of every Game and its moves as newline-delimited JSON. It
+    runs as a chain of tasks that each write one ExportChunk and save the
+    query cursor here in the same transaction, so a failed export resumes
+    after the last chunk written"""
+    cursor = ndb.StringProperty(indexed=False)
+    chunks = ndb.IntegerProperty(default=0, indexed=False)
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    moves = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def start(cls, job_id=None):
+        """Starts a new export, or resumes the unfinished one with that id
+        from its last chunk. Returns the job, or None if there is none"""
+        if job_id is None:
+            job = cls()
+            job.put()
+        else:
+            job = cls.get_by_id(job_id)
+            if not job:
+                return None
+        if not job.done:
+            cls._queue_chunk(job.key, job.chunks)
+        return job
+
+    @staticmethod
+    def _queue_chunk(job_key, chunk, transactional=False):
+        # Only exports queue tasks, the endpoints don't need the module
+        from google.appengine.api import taskqueue
+        taskqueue.add(url='/tasks/export/chunk',
+                      params={'job': job_key.id(), 'chunk': chunk},
+                      queue_name='export',
+                      transactional=transactional)
+
+    @classmethod
+    def write_chunk(cls, job_key, chunk):
+        """Exports the next games as one chunk of at most EXPORT_CHUNK_BYTES
+        and queues the following chunk. Games are read EXPORT_BATCH_SIZE at
+        a time, a game bigger than the limit gets a chunk of its own. A
+        chunk that was already written is skipped, so retried tasks are
+        harmless"""
+        job = job_key.get()
+        if not job or job.done or job.chunks != chunk:
+            return
+        games = Game.query().iter(start_cursor=Cursor(urlsafe=job.cursor),
+                                  produce_cursors=True,
+                                  batch_size=settings.EXPORT_BATCH_SIZE,
+                                  use_cache=False, use_memcache=False)
+        lines, size, moves, cursor, full = [], 0, 0, None, False
+        while not full:
+            batch = [(game, games.cursor_after()) for game in
+                     itertools.islice(games, settings.EXPORT_BATCH_SIZE)]
+            if not batch:
+                break
+            names = get_user_names(game.user for game, _ in batch)
+            for game, after in batch:
+                line = json.dumps(game.export_record(names.get(game.user)),
+                                  sort_keys=True) + '\n'
+                if lines and size + len(line) > settings.EXPORT_CHUNK_BYTES:
+                    full = True
+                    break
+                lines.append(line)
+                size += len(line)
+                moves += len(game.move_log)
+                cursor = after
+        cls._save_chunk(job_key, chunk, ''.join(lines), len(lines), moves,
+                        cursor.urlsafe() if full else None)
+
+    @classmethod
+    @ndb.transactional
+    def _save_chunk(cls, job_key, chunk, data, games, moves, cursor):
+        job = job_key.get()
+        if job.chunks != chunk:
+            return
+        ExportChunk(key=ExportChunk.key_for(job_key, chunk),
+                    data=data).put()
+        job.chunks += 1
+        job.games += games
+        job.moves += moves
+        job.cursor = cursor
+        if cursor:
+            cls._queue_chunk(job_key, job.chunks, transactional=True)
+        else:
+            job.done = True
+            job.finished = datetime.utcnow()
+        job.put()
+
+
+class ExportChunk(ndb.Model):
+    """One batch of NDJSON lines of an ExportJob, a child of the job"""
+    data = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, job_key, chunk):
+        return ndb.Key(cls, chunk + 1, parent=job_key)
@@ -0,0 +1,106 @@
+"""settings.py - Tunable values shared by the API and the task handlers."""
+
+# Players returned by get_high_scores and get_user_rankings
+LEADERBOARD_SIZE = 5
+
+# Entries kept in each leaderboard snapshot. The surplus over
+# LEADERBOARD_SIZE covers players whose percentage drops between rebuilds.
+LEADERBOARD_DEPTH = 25
+
+# Seconds a Game and its rendered board stay in memcache
+GAME_CACHE_TTL = 600
+
+# Page size used by get_user_games and get_game_history when the request
+# doesn't set one, and the largest page a request may ask for
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Users handed to each reminder send task, and how many emails a send task
+# sends between checkpoints. Checkpoints outlive their task long enough to
+# catch a redelivered one, and are deleted by the hourly reminder cron after
+# REMINDER_CHECKPOINT_HOURS.
+REMINDER_BATCH_SIZE = 100
+REMINDER_CHECKPOINT_EVERY = 10
+REMINDER_CHECKPOINT_HOURS = 24
+
+# Log RPC counts and phase timings for every endpoint call
+INSTRUMENTATION_ENABLED = True
+
+# Fall back to a name query for Users that still have automatic ids. Turn
+# off once /tasks/migrate_users has re-keyed every User by name.
+LEGACY_USER_LOOKUP = True
+
+# Most ships a new game may ask for
+MAX_SHIPS = 10
+
+# Largest batches accepted by new_games and make_moves
+MAX_BULK_GAMES = 100
+MAX_BULK_MOVES = 500
+
+# Entity groups one cross-group transaction may touch
+MAX_TRANSACTION_GROUPS = 25
+
+# StatShards per User. A User's shards plus their Score and GlobalStats
+# must fit in one cross-group transaction.
+USER_STAT_SHARDS = 5
+
+# The stats rollup re-reads shards changed this many seconds before the
+# previous rollup ended, to cover index lag. Shards are read in batches of
+# STATS_ROLLUP_BATCH.
+STATS_ROLLUP_MARGIN = 60
+STATS_ROLLUP_BATCH = 100
+
+# With SCORE_WRITE_BEHIND, game counter changes are queued as a task on the
+# SCORE_DELTA_QUEUE pull queue, in the transaction of the change, instead of
+# being added to a StatShard. /crons/apply_score_deltas leases them
+# SCORE_DELTA_BATCH at a time for SCORE_DELTA_LEASE seconds and folds them
+# into Score, GlobalStats and the Leaderboard. Each worker stops leasing
+# after SCORE_WORKER_SECONDS, under load or not, so it is done before the
+# cron starts the next one. When idle it polls the queue every
+# SCORE_MAX_STALENESS seconds, which bounds how far the scores lag behind.
+# Every task applied to a Score leaves a marker under it, so a batch leased
+# again after a worker died is not counted twice. Tasks are deleted once
+# applied, so the markers are only needed for a lease or two and are swept
+# after SCORE_MARKER_DAYS.
+SCORE_WRITE_BEHIND = False
+SCORE_DELTA_QUEUE = 'score-deltas'
+SCORE_DELTA_BATCH = 1000
+SCORE_DELTA_LEASE = 60
+SCORE_MAX_STALENESS = 10
+SCORE_WORKER_SECONDS = 50
+SCORE_MARKER_DAYS = 1
+
+# Games in progress that nobody played for ABANDONED_GAME_DAYS are deleted by
+# the daily reaper, REAPER_BATCH_SIZE at a time. Each request deletes batches
+# for REAPER_TIME_BUDGET seconds, then hands the rest to a task. With
+# REAPER_ARCHIVE the deleted games are counted as abandoned in Score.
+ABANDONED_GAME_DAYS = 30
+REAPER_BATCH_SIZE = 500
+REAPER_TIME_BUDGET = 60
+REAPER_ARCHIVE = True
+
+# Bytes of NDJSON per ExportChunk of the export, well under the 1MB entity
+# limit, and games read at a time while a chunk is written.
+EXPORT_CHUNK_BYTES = 512 * 1024
+EXPORT_BATCH_SIZE = 100
+
+# Token bucket limits of the admission checks as (requests per second,
+# burst), per User and per Game key. ADMISSION_ENABLED turns the limits off,
+# the request checks that need no I/O always run. Each instance keeps at most
+# ADMISSION_MAX_BUCKETS buckets. With ADMISSION_SHARED the requests are also
+# counted in memcache, so the limits hold across instances. make_moves
+# charges each game once for all its moves, which may run its bucket into
+# debt.
+RATE_LIMITS = {
+    'user': (5.0, 20),
+    'game': (2.0, 10),
+}
+ADMISSION_ENABLED = True
+ADMISSION_MAX_BUCKETS = 10000
+ADMISSION_SHARED = True
+
+# Keys found not to exist are remembered by each instance for
+# NEGATIVE_CACHE_TTL seconds, at most NEGATIVE_CACHE_SIZE of them, so repeated
+# lookups of deleted or bogus games cost no datastore read.
+NEGATIVE_CACHE_TTL = 300
+NEGATIVE_CACHE_SIZE = 10000
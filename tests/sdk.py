@@ -0,0 +1,43 @@
+"""sdk.py - Runs tests against the App Engine testbed stubs. Set
+APPENGINE_SDK to the SDK directory to run them, they are skipped without it:
+
+    APPENGINE_SDK=~/google_appengine python -m unittest discover tests"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_api import activate_testbed, setup_sdk
+
+SDK = os.environ.get('APPENGINE_SDK')
+if SDK:
+    setup_sdk(os.path.expanduser(SDK))
+
+requires_sdk = unittest.skipUnless(SDK, 'APPENGINE_SDK is not set')
+
+
+class TestbedCase(unittest.TestCase):
+    """Activates fresh stubs and forgets the instance-local caches for
+    every test"""
+
+    def setUp(self):
+        from google.appengine.ext import ndb
+        import admission
+        import utils
+
+        self.bed = activate_testbed()
+        ndb.get_context().clear_cache()
+        admission._buckets.clear()
+        utils._missing.clear()
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def call(self, method, request):
+        """Runs an endpoint method as its own request, see
+        bench_api.Recorder"""
+        from google.appengine.ext import ndb
+        return ndb.toplevel(method)(request)
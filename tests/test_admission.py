@@ -0,0 +1,80 @@
+"""test_admission.py - Tests for the token buckets and the shared memcache
+counters of the admission checks, run on the App Engine testbed, see
+sdk.py."""
+
+import unittest
+
+import sdk
+
+if sdk.SDK:
+    import endpoints
+    import admission
+    import settings
+
+
+@sdk.requires_sdk
+class TokenBucketTest(sdk.TestbedCase):
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = admission.TokenBucket(10, 0)
+        self.assertTrue(bucket.take(1.0, 10, 100))
+        self.assertEqual(bucket.tokens, 9)
+
+    def test_cost_over_tokens_runs_into_debt(self):
+        bucket = admission.TokenBucket(10, 0)
+        self.assertTrue(bucket.take(1.0, 10, 0, cost=15))
+        self.assertEqual(bucket.tokens, -5)
+        self.assertFalse(bucket.take(1.0, 10, 0))
+        # The debt is paid back before anything else is admitted
+        self.assertFalse(bucket.take(1.0, 10, 5))
+        self.assertTrue(bucket.take(1.0, 10, 6))
+
+    def test_empty_bucket_refuses(self):
+        bucket = admission.TokenBucket(2, 0)
+        self.assertTrue(bucket.take(1.0, 2, 0))
+        self.assertTrue(bucket.take(1.0, 2, 0))
+        self.assertFalse(bucket.take(1.0, 2, 0))
+
+
+@sdk.requires_sdk
+class TakeSharedTest(sdk.TestbedCase):
+
+    def test_refused_once_the_window_reached_burst(self):
+        # rate 2, burst 10: windows of 5 seconds
+        for cost, refused in ((6, set()), (6, set()), (6, set(['a']))):
+            self.assertEqual(
+                admission._take_shared({'a': cost}, 2.0, 10, 100), refused)
+
+    def test_new_window_starts_over(self):
+        admission._take_shared({'a': 20}, 2.0, 10, 100)
+        self.assertEqual(admission._take_shared({'a': 1}, 2.0, 10, 104),
+                         set(['a']))
+        self.assertEqual(admission._take_shared({'a': 1}, 2.0, 10, 105),
+                         set())
+
+    def test_several_names_in_one_call(self):
+        admission._take_shared({'a': 10}, 2.0, 10, 100)
+        self.assertEqual(
+            admission._take_shared({'a': 1, 'b': 1}, 2.0, 10, 100),
+            set(['a']))
+
+
+@sdk.requires_sdk
+class AdmitTest(sdk.TestbedCase):
+
+    def test_admit_multi_charges_each_key_once(self):
+        rate, burst = settings.RATE_LIMITS['game']
+        self.assertEqual(admission.admit_multi('game', {'g1': burst * 2,
+                                                        'g2': 1}), set())
+        self.assertEqual(admission.admit_multi('game', {'g1': 1, 'g2': 1}),
+                         set(['g1']))
+
+    def test_admit_raises_when_refused(self):
+        rate, burst = settings.RATE_LIMITS['user']
+        admission.admit_multi('user', {'ann': burst})
+        with self.assertRaises(endpoints.ForbiddenException):
+            admission.admit('user', 'ann')
+
+
+if __name__ == '__main__':
+    unittest.main()
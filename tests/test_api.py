@@ -0,0 +1,121 @@
+"""test_api.py - Tests for the make_moves batching and the get_user_games
+paging, run on the App Engine testbed, see sdk.py."""
+
+import unittest
+
+import sdk
+
+if sdk.SDK:
+    import endpoints
+    from google.appengine.ext import ndb
+    import api
+    import settings
+    from models import Game, User
+
+
+def _moves(games):
+    """Returns (index, game key, user key, guess) moves for a list of
+    (game id, user name, moves) tuples"""
+    moves = []
+    for game_id, user_name, count in games:
+        for guess in range(1, count + 1):
+            moves.append((len(moves), ndb.Key(Game, game_id),
+                          ndb.Key(User, user_name), guess))
+    return moves
+
+
+def _groups(batch):
+    return (set(move[1] for move in batch) |
+            set(move[2] for move in batch))
+
+
+@sdk.requires_sdk
+class MoveBatchesTest(sdk.TestbedCase):
+
+    def test_batches_fit_a_transaction(self):
+        moves = _moves([(game, 'user-{}'.format(game), 1)
+                        for game in range(1, 41)])
+        batches = api._move_batches(moves)
+        # Each game and its owner take two groups
+        self.assertEqual([len(batch) for batch in batches], [12, 12, 12, 4])
+        for batch in batches:
+            self.assertLessEqual(len(_groups(batch)),
+                                 settings.MAX_TRANSACTION_GROUPS)
+        self.assertEqual(sorted(move for batch in batches for move in batch),
+                         moves)
+
+    def test_owner_games_share_a_batch(self):
+        moves = _moves([(game, 'owner', 1) for game in range(1, 31)])
+        batches = api._move_batches(moves)
+        # The owner's StatShard counts once per batch
+        self.assertEqual([len(batch) for batch in batches], [24, 6])
+
+    def test_moves_on_a_game_stay_together_in_order(self):
+        moves = _moves([(game, 'user-{}'.format(game), 3)
+                        for game in range(1, 21)])
+        batches = api._move_batches(moves)
+        for game in range(1, 21):
+            key = ndb.Key(Game, game)
+            holding = [batch for batch in batches
+                       if any(move[1] == key for move in batch)]
+            self.assertEqual(len(holding), 1)
+            self.assertEqual([move[3] for move in holding[0]
+                              if move[1] == key], [1, 2, 3])
+
+
+@sdk.requires_sdk
+class GetUserGamesTest(sdk.TestbedCase):
+
+    def setUp(self):
+        super(GetUserGamesTest, self).setUp()
+        self.admission = settings.ADMISSION_ENABLED
+        settings.ADMISSION_ENABLED = False
+        self.service = api.Battleship()
+        self.call(self.service.create_user,
+                  api.USER_REQUEST.combined_message_class(user_name='ann'))
+        created = self.call(self.service.new_games,
+                            api.NewGamesForm(user_name='ann', count=5))
+        self.keys = sorted((item.game.urlsafe_key for item in created.items),
+                           key=lambda urlsafe: ndb.Key(
+                               urlsafe=urlsafe).pairs())
+
+    def tearDown(self):
+        settings.ADMISSION_ENABLED = self.admission
+        super(GetUserGamesTest, self).tearDown()
+
+    def page(self, cursor=None):
+        return self.call(self.service.get_user_games,
+                         api.UserGameForm(user_name='ann', page_size=2,
+                                          cursor=cursor))
+
+    def test_pages_in_key_order(self):
+        seen = []
+        cursor = None
+        while True:
+            page = self.page(cursor)
+            seen.extend(item.urlsafe_key for item in page.items)
+            if not page.more:
+                break
+            self.assertEqual(page.next_cursor, seen[-1])
+            cursor = page.next_cursor
+        self.assertEqual(seen, self.keys)
+        self.assertIsNone(page.next_cursor)
+
+    def test_cursor_game_ending_skips_nothing(self):
+        first = self.page()
+        self.call(self.service.cancel_game,
+                  api.GET_GAME_REQUEST.combined_message_class(
+                      urlsafe_game_key=first.next_cursor))
+        second = self.page(first.next_cursor)
+        self.assertEqual([item.urlsafe_key for item in second.items],
+                         self.keys[2:4])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(endpoints.BadRequestException):
+            self.page('not-a-key')
+        with self.assertRaises(endpoints.BadRequestException):
+            self.page(ndb.Key(User, 'ann').urlsafe())
+
+
+if __name__ == '__main__':
+    unittest.main()
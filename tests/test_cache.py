@@ -0,0 +1,80 @@
+"""test_cache.py - Tests for the placeholder and compare-and-set fill of the
+Game cache, run on the App Engine testbed, see sdk.py."""
+
+import unittest
+
+import sdk
+
+if sdk.SDK:
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    import cache
+    from models import Game, User
+
+
+def _cached(key):
+    return memcache.get(key.urlsafe(), namespace=cache.NAMESPACE)
+
+
+@sdk.requires_sdk
+class GetMultiTest(sdk.TestbedCase):
+
+    def setUp(self):
+        super(GetMultiTest, self).setUp()
+        user = User(key=User.key_for_name('ann'), name='ann')
+        user.put()
+        self.game = Game.build(user.key, 5)
+        self.key = ndb.toplevel(self.game.put)()
+
+    def get(self, keys):
+        ndb.get_context().clear_cache()
+        return cache.get_multi_async(keys).get_result()
+
+    def test_miss_fills_and_hit_is_counted(self):
+        before = cache.stats()
+        self.assertEqual(self.get([self.key])[0].key, self.key)
+        self.assertIsInstance(_cached(self.key), tuple)
+        self.assertEqual(self.get([self.key])[0].key, self.key)
+        after = cache.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_entry_being_filled_is_left_alone(self):
+        memcache.add(self.key.urlsafe(), cache._LOCKED,
+                     namespace=cache.NAMESPACE)
+        self.assertEqual(self.get([self.key])[0].key, self.key)
+        self.assertEqual(_cached(self.key), cache._LOCKED)
+
+    def test_write_during_fill_is_not_overwritten(self):
+        read = ndb.get_multi_async
+
+        def write_then_read(keys, **options):
+            # Another request commits a write after the placeholder was
+            # claimed and drops the entry
+            memcache.delete(self.key.urlsafe(), namespace=cache.NAMESPACE)
+            return read(keys, **options)
+
+        cache.ndb.get_multi_async = write_then_read
+        try:
+            self.assertEqual(self.get([self.key])[0].key, self.key)
+        finally:
+            cache.ndb.get_multi_async = read
+        self.assertIsNone(_cached(self.key))
+
+    def test_missing_game_releases_its_placeholder(self):
+        missing = ndb.Key(Game, 'gone')
+        self.assertEqual(self.get([missing, self.key])[0], None)
+        self.assertIsNone(_cached(missing))
+        self.assertIsInstance(_cached(self.key), tuple)
+
+    def test_put_invalidates(self):
+        self.get([self.key])
+        game = self.key.get()
+        game.attempts_remaining -= 1
+        ndb.toplevel(game.put)()
+        self.assertIsNone(_cached(self.key))
+        self.assertEqual(self.get([self.key])[0].attempts_remaining, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
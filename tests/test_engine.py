@@ -0,0 +1,83 @@
+"""test_engine.py - Unit tests for the game rules and the Board. Both are
+plain Python, so they run without the App Engine SDK:
+
+    python -m unittest discover tests"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from board import Board
+import engine
+
+
+def match(ships, attempts, width=5, height=5):
+    return engine.Match(Board(width, height, ships), attempts)
+
+
+class PlayTest(unittest.TestCase):
+
+    def test_win_on_last_attempt(self):
+        game = match([[3]], 2)
+        self.assertEqual(engine.play(game, 1), engine.MISS)
+        self.assertEqual(engine.play(game, 3), engine.WON)
+        self.assertEqual(game.attempts_remaining, 0)
+        self.assertTrue(game.game_over)
+
+    def test_loss_on_last_attempt(self):
+        game = match([[3]], 2)
+        engine.play(game, 1)
+        self.assertEqual(engine.play(game, 2), engine.LOST)
+        self.assertTrue(game.game_over)
+
+    def test_duplicate_guess(self):
+        game = match([[3]], 5)
+        engine.play(game, 1)
+        with self.assertRaises(engine.InvalidMove):
+            engine.play(game, 1)
+        self.assertEqual(game.attempts_remaining, 4)
+        self.assertFalse(game.game_over)
+
+    def test_out_of_range(self):
+        game = match([[3]], 5)
+        for guess in (0, 26):
+            with self.assertRaises(engine.InvalidMove):
+                engine.play(game, guess)
+        self.assertEqual(game.attempts_remaining, 5)
+
+    def test_hit_then_sunk(self):
+        game = match([[1, 2], [10]], 10)
+        self.assertEqual(engine.play(game, 1), engine.HIT)
+        self.assertEqual(engine.play(game, 2), engine.SUNK)
+        self.assertEqual(engine.play(game, 10), engine.WON)
+
+
+class BoardTest(unittest.TestCase):
+
+    def test_render(self):
+        board = Board(3, 2, [[1, 2]])
+        board.fire(2)
+        board.fire(6)
+        self.assertEqual(board.render(), 'OXOOOX')
+        self.assertEqual(board.render(reveal=True), 'OSOOOX')
+        self.assertEqual(board.rows(board.render()), ['O X O', 'O O X'])
+
+    def test_legacy_game(self):
+        board = Board.from_legacy(5, 5, 13, [1, 7])
+        self.assertTrue(board.is_shot(7))
+        self.assertFalse(board.is_shot(13))
+        self.assertFalse(board.all_sunk())
+
+        game = engine.Match(board, 3)
+        self.assertEqual(engine.play(game, 13), engine.WON)
+
+    def test_legacy_game_already_won(self):
+        board = Board.from_legacy(5, 5, 13, [13])
+        self.assertTrue(board.all_sunk())
+
+
+if __name__ == '__main__':
+    unittest.main()
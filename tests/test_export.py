@@ -0,0 +1,70 @@
+"""test_export.py - Tests for the sizing of the NDJSON export chunks, run
+on the App Engine testbed, see sdk.py."""
+
+import json
+import unittest
+
+import sdk
+
+if sdk.SDK:
+    import settings
+    from models import ExportChunk, ExportJob, Game, User
+
+
+@sdk.requires_sdk
+class WriteChunkTest(sdk.TestbedCase):
+
+    def setUp(self):
+        super(WriteChunkTest, self).setUp()
+        self.settings = settings.EXPORT_CHUNK_BYTES, settings.EXPORT_BATCH_SIZE
+        settings.EXPORT_BATCH_SIZE = 3
+        user = User(key=User.key_for_name('ann'), name='ann')
+        user.put()
+        self.keys = set()
+        for moves in range(10):
+            game = Game.build(user.key, 25)
+            # Games of different sizes
+            for cell in range(1, moves * 2 + 1):
+                game.fire(cell)
+            self.keys.add(game.put().urlsafe())
+
+    def tearDown(self):
+        settings.EXPORT_CHUNK_BYTES, settings.EXPORT_BATCH_SIZE = self.settings
+        super(WriteChunkTest, self).tearDown()
+
+    def export(self):
+        """Runs an export chunk by chunk. Returns the job and the lines of
+        each chunk"""
+        job = ExportJob()
+        job.put()
+        while not job.done:
+            ExportJob.write_chunk(job.key, job.chunks)
+            job = job.key.get()
+            self.assertLess(job.chunks, 100)
+        chunks = [ExportChunk.key_for(job.key, chunk).get().data
+                  for chunk in range(job.chunks)]
+        return job, [chunk.splitlines() for chunk in chunks]
+
+    def assertExportedOnce(self, job, chunks):
+        lines = [line for chunk in chunks for line in chunk]
+        self.assertEqual(sorted(json.loads(line)['game'] for line in lines),
+                         sorted(self.keys))
+        self.assertEqual(job.games, len(self.keys))
+
+    def test_chunks_stay_under_the_limit(self):
+        settings.EXPORT_CHUNK_BYTES = 1000
+        job, chunks = self.export()
+        self.assertGreater(job.chunks, 1)
+        for chunk in chunks:
+            self.assertLessEqual(sum(len(line) + 1 for line in chunk), 1000)
+        self.assertExportedOnce(job, chunks)
+
+    def test_game_over_the_limit_gets_its_own_chunk(self):
+        settings.EXPORT_CHUNK_BYTES = 50
+        job, chunks = self.export()
+        self.assertEqual([len(chunk) for chunk in chunks], [1] * 10)
+        self.assertExportedOnce(job, chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
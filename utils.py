@@ -1,25 +1,32 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import threading
+import time
+from collections import OrderedDict
 from google.appengine.ext import ndb
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+import settings
+
+_missing_lock = threading.Lock()
+# urlsafe key -> time it stops being known as missing, oldest first
+_missing = OrderedDict()
+
+
+def decode_key(urlsafe, model):
+    """Decodes a urlsafe key string without any RPC and checks the kind
+        from the key path.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key.
     Raises:
-        ValueError:"""
+        BadRequestException: The key string is malformed.
+        ValueError: The key is of another kind."""
     try:
         key = ndb.Key(urlsafe=urlsafe)
-        print key;
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -27,10 +34,111 @@ def get_by_urlsafe(urlsafe, model):
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
-
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def is_missing(key):
+    """Whether the key was recently found not to exist"""
+    urlsafe = key.urlsafe()
+    with _missing_lock:
+        expires = _missing.get(urlsafe)
+        if expires is None:
+            return False
+        if expires > time.time():
+            return True
+        del _missing[urlsafe]
+        return False
+
+
+def remember_missing(keys):
+    """Records keys that don't exist for NEGATIVE_CACHE_TTL seconds. At
+    most NEGATIVE_CACHE_SIZE keys are kept, the oldest are dropped first"""
+    expires = time.time() + settings.NEGATIVE_CACHE_TTL
+    with _missing_lock:
+        for key in keys:
+            urlsafe = key.urlsafe()
+            _missing.pop(urlsafe, None)
+            _missing[urlsafe] = expires
+        while len(_missing) > settings.NEGATIVE_CACHE_SIZE:
+            _missing.popitem(last=False)
+
+
+def forget_missing(key):
+    """Drops a key from the negative cache once it has been written"""
+    with _missing_lock:
+        _missing.pop(key.urlsafe(), None)
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind, before
+        any datastore call. Keys recently found missing are answered from
+        an instance-local negative cache. Raises an error if the key String
+        is malformed or the entity is of the incorrect kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    return get_multi_by_urlsafe([urlsafe], model)[0]
+
+
+def get_multi_by_urlsafe(urlsafes, model):
+    """Batch version of get_by_urlsafe, with one get_multi for the keys
+        that aren't known to be missing.
+    Args:
+        urlsafes: A list of urlsafe key strings
+        model: The expected entity kind
+    Returns:
+        The entities in the order of urlsafes, None for missing ones.
+    Raises:
+        BadRequestException: A key string is malformed.
+        ValueError: A key is of another kind."""
+    keys = [decode_key(urlsafe, model) for urlsafe in urlsafes]
+    fetch = [key for key in keys if not is_missing(key)]
+    loaded = dict(zip(fetch, ndb.get_multi(fetch)))
+    remember_missing(key for key in fetch if loaded[key] is None)
+    return [loaded.get(key) for key in keys]
+
+
+def get_user_name(user_key):
+    """Returns the name of a User. Users keyed by name cost no datastore
+    call, only Users still on automatic ids are fetched"""
+    if isinstance(user_key.id(), basestring):
+        return user_key.id()
+    return user_key.get().name
+
+
+@ndb.tasklet
+def get_user_name_async(user_key):
+    """Tasklet version of get_user_name"""
+    if isinstance(user_key.id(), basestring):
+        raise ndb.Return(user_key.id())
+    user = yield user_key.get_async()
+    raise ndb.Return(user.name)
+
+
+def get_user_names(user_keys):
+    """Resolves the names of many Users with at most one batched datastore
+    call. Users keyed by name are resolved from their key.
+    Args:
+        user_keys: An iterable of User keys, duplicates are allowed
+    Returns:
+        A dict mapping each User key to its name. Users on automatic ids
+        that no longer exist are left out."""
+    names = {}
+    fetch = set()
+    for key in user_keys:
+        if isinstance(key.id(), basestring):
+            names[key] = key.id()
+        else:
+            fetch.add(key)
+    fetch = list(fetch)
+    names.update((key, user.name)
+                 for key, user in zip(fetch, ndb.get_multi(fetch)) if user)
+    return names